@@ -2,20 +2,58 @@
 # -*- coding: utf-8 -*-
 
 # standard library
+import json
+import os
+from collections import OrderedDict
+from fractions import Fraction
+from itertools import islice
 from distutils.version import LooseVersion
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 # external dependencies
 import numpy as np
-from numpy.fft import fft, fftfreq
 from scipy import __version__ as scipy_version
-from scipy.integrate import trapz, cumtrapz
+from scipy import fftpack
+from scipy.integrate import cumtrapz
 from scipy.interpolate import UnivariateSpline
+from scipy.linalg import solve_triangular
 from scipy.optimize import fmin
-from scipy.signal import butter, filtfilt
-from scipy.stats import nanmean
+from scipy.signal import (butter, filtfilt, firwin, get_window, lfilter,
+                          lfilter_zi)
 from scipy import sparse
+from scipy.sparse.linalg import splu
 import matplotlib.pyplot as plt
 
+try:
+    from numpy import nanmean
+except ImportError:  # NumPy < 1.8.0
+    from scipy.stats import nanmean
+
+# The SciPy version is only parsed once, as some of these functions are
+# called many times.
+_SCIPY_VERSION = LooseVersion(scipy_version)
+_SCIPY_HAS_FILTFILT_AXIS = _SCIPY_VERSION >= LooseVersion('0.10.0')
+_SCIPY_HAS_SOS = _SCIPY_VERSION >= LooseVersion('0.16.0')
+_SCIPY_HAS_SOSFILTFILT = _SCIPY_VERSION >= LooseVersion('0.18.0')
+
+if _SCIPY_HAS_SOS:
+    from scipy.signal import sosfilt, sosfilt_zi
+if _SCIPY_HAS_SOSFILTFILT:
+    from scipy.signal import sosfiltfilt
+
+# least recently used cache of Butterworth filter designs
+_BUTTER_CACHE = OrderedDict()
+_BUTTER_CACHE_SIZE = 128
+
+# the largest sparse least squares problem whose full covariance, a dense
+# matrix, least_squares_variance computes
+_SPARSE_INVERSE_MAX_PARAMETERS = 2000
+
+# least recently used cache of polyphase resampling filters
+_RESAMPLE_CACHE = OrderedDict()
+_RESAMPLE_CACHE_SIZE = 128
+
 
 def sync_error(tau, signal1, signal2, time, plot=False):
     '''Returns the error between two signal time histories given a time
@@ -30,7 +68,7 @@ def sync_error(tau, signal1, signal2, time, plot=False):
         typically "cleaner" that signal2 and/or has a higher sample rate.
     signal2 : ndarray, shape(n,)
         The signal that will be shifted to syncronize with signal 1.
-    time : ndarray, shape(n,)
+    time : ndarray, shape(n,) or TimeBase
         The time vector for the two signals
     plot : boolean, optional, default=False
         If true a plot will be shown of the resulting signals.
@@ -50,21 +88,20 @@ def sync_error(tau, signal1, signal2, time, plot=False):
     # signal
     shiftedTime = time + tau
 
-    # create time vector where the two signals overlap
+    # create time vector where the two signals overlap, the times are
+    # sorted so this is a range of samples
     if tau > 0:
-        intervalTime = shiftedTime[np.nonzero(shiftedTime < time[-1])]
+        start, stop = 0, shiftedTime.searchsorted(time[-1], side='left')
     else:
-        intervalTime = shiftedTime[np.nonzero(shiftedTime > time[0])]
+        start, stop = shiftedTime.searchsorted(time[0], side='right'), None
+    intervalTime = shiftedTime[start:stop]
 
     # interpolate between signal 1 samples to find points that correspond in
     # time to signal 2 on the shifted time
-    sig1OnInterval = np.interp(intervalTime, time, signal1)
+    sig1OnInterval = _interp(intervalTime, time, signal1)
 
     # truncate signal 2 to the time interval
-    if tau > 0:
-        sig2OnInterval = signal2[np.nonzero(shiftedTime <= intervalTime[-1])]
-    else:
-        sig2OnInterval = signal2[np.nonzero(shiftedTime >= intervalTime[0])]
+    sig2OnInterval = signal2[start:stop]
 
     if plot is True:
         fig, axes = plt.subplots(2, 1)
@@ -83,7 +120,79 @@ def sync_error(tau, signal1, signal2, time, plot=False):
     return error
 
 
-def find_timeshift(signal1, signal2, sample_rate, guess=None, plot=False):
+def batch_sync_error(taus, signal1, signal2, time, interpolant=None,
+                     block_size=2 ** 22):
+    """Returns the error between two signal time histories for an array of
+    time shifts. The result is the same as calling sync_error for each tau,
+    but the computation is vectorized.
+
+    Parameters
+    ----------
+    taus : array_like, shape(m,)
+        The time shifts.
+    signal1 : ndarray, shape(n,)
+        The signal that will be interpolated. This signal is typically
+        "cleaner" that signal2 and/or has a higher sample rate.
+    signal2 : ndarray, shape(n,)
+        The signal that will be shifted to syncronize with signal 1.
+    time : ndarray, shape(n,) or TimeBase
+        The time vector for the two signals
+    interpolant : callable, optional, default=None
+        A function that returns the values of signal1 at an array of times,
+        e.g. a scipy.interpolate.interp1d instance. Build it once and pass
+        it to repeated calls to avoid recomputing it. If None, signal1 is
+        linearly interpolated with numpy.interp.
+    block_size : integer, optional, default=2**22
+        The maximum number of interpolated samples held in memory at once.
+        The taus are processed in blocks of this size.
+
+    Returns
+    -------
+    error : ndarray, shape(m,)
+        Error between the two signals for each tau.
+
+    """
+    taus = np.atleast_1d(np.asarray(taus, dtype=float))
+    time = np.asarray(time)
+
+    # make sure the taus aren't too large
+    if len(taus) > 0 and np.max(np.abs(taus)) >= time[-1]:
+        raise ValueError(('abs(tau), {0}, must be less than or equal to ' +
+                         '{1}').format(str(np.max(np.abs(taus))),
+                                       str(time[-1])))
+
+    if interpolant is None:
+        interpolant = lambda t: np.interp(t, time, signal1)
+
+    error = np.zeros(len(taus))
+
+    rows = max(1, int(block_size) // len(time))
+    for start in range(0, len(taus), rows):
+        block = taus[start:start + rows, np.newaxis]
+
+        # this is the time for the second signal which is assumed to lag the
+        # first signal, one row per tau
+        shifted_time = time + block
+
+        # mask the times where the two signals overlap
+        overlap = np.where(block > 0, shifted_time < time[-1],
+                           shifted_time > time[0])
+
+        # interpolate between signal 1 samples to find points that
+        # correspond in time to signal 2 on the shifted time, the times
+        # outside of the overlap are clipped as they are masked anyway
+        sample_times = np.clip(shifted_time, time[0], time[-1])
+        sig1_on_interval = interpolant(sample_times.ravel()).reshape(
+            shifted_time.shape)
+
+        difference = np.where(overlap, sig1_on_interval - signal2, 0.0)
+        error[start:start + rows] = np.sqrt(np.sum(difference ** 2, axis=1))
+
+    return error
+
+
+def find_timeshift(signal1, signal2, sample_rate, guess=None, plot=False,
+                   method='landscape', disp=False, full_output=False):
     '''Returns the timeshift, tau, of the second signal relative to the
     first signal.
 
@@ -100,11 +209,32 @@ def find_timeshift(signal1, signal2, sample_rate, guess=None, plot=False):
         If you've got a good guess for the time shift then supply it here.
     plot : boolean, optional, defaul=False
         If true, a plot of the error landscape will be shown.
+    method : string, optional, {'landscape'|'xcorr'|'pyramid'},
+             default='landscape'
+        How the initial guess is found when `guess` is None. 'landscape'
+        evaluates `sync_error` over a range of time shifts spanning a quarter
+        of the signal duration in each direction.
+        'xcorr' computes the same error at every integer sample lag with an
+        FFT based cross-correlation, O(n log n) instead of O(n^2), and then
+        refines the minimum to sub-sample accuracy with a parabolic fit.
+        'pyramid' does the same on a decimated copy of the signals and then
+        only searches near that estimate at each finer level, see
+        pyramid_timeshift.
+    disp : boolean, optional, default=False
+        If true, the initial guess and the optimizer's convergence messages
+        are printed.
+    full_output : boolean, optional, default=False
+        If true, the final error and the convergence flag are also returned.
 
     Returns
     -------
     tau : float
         The timeshift between the two signals.
+    error : float
+        The sync_error at tau, only returned if full_output is True.
+    converged : boolean
+        False if the optimizer hit its maximum number of iterations or
+        function evaluations, only returned if full_output is True.
 
     '''
     # raise an error if the signals are not the same length
@@ -115,18 +245,31 @@ def find_timeshift(signal1, signal2, sample_rate, guess=None, plot=False):
     signal1 = normalize(subtract_mean(signal1))
     signal2 = normalize(subtract_mean(signal2))
 
-    time = time_vector(len(signal1), sample_rate)
+    time = time_vector(len(signal1), sample_rate, lazy=True)
 
     if guess is None:
-        # set up the error landscape, error vs tau
-        # We assume the time shift is
-        tau_range = np.linspace(-time[len(time) / 4], time[len(time) / 4],
-                                num=len(time) / 10)
-
-        # TODO : Can I vectorize this?
-        error = np.zeros_like(tau_range)
-        for i, val in enumerate(tau_range):
-            error[i] = sync_error(val, signal1, signal2, time)
+        if method == 'landscape':
+            # set up the error landscape, error vs tau
+            # We assume the time shift is
+            tau_range = np.linspace(-time[len(time) // 4],
+                                    time[len(time) // 4],
+                                    num=len(time) // 10)
+
+            error = batch_sync_error(tau_range, signal1, signal2, time)
+
+            # find initial condition from landscape
+            tau0 = tau_range[np.argmin(error)]
+        elif method == 'xcorr':
+            lags, error = _xcorr_error(signal1, signal2, len(time) // 4)
+            tau_range = lags / float(sample_rate)
+            tau0 = _refine_lag(lags, error) / sample_rate
+        elif method == 'pyramid':
+            lags, error = _pyramid_search(signal1, signal2, sample_rate)
+            tau_range = lags / float(sample_rate)
+            tau0 = _refine_lag(lags, error) / sample_rate
+        else:
+            raise ValueError("{} is not a valid method, use 'landscape', "
+                             "'xcorr' or 'pyramid'.".format(method))
 
         if plot is True:
             plt.figure()
@@ -134,19 +277,379 @@ def find_timeshift(signal1, signal2, sample_rate, guess=None, plot=False):
             plt.xlabel('tau')
             plt.ylabel('error')
             plt.show()
-
-        # find initial condition from landscape
-        tau0 = tau_range[np.argmin(error)]
     else:
         tau0 = guess
 
+    if disp is True:
+        print("The minimun of the error landscape is {}.".format(tau0))
+
+    tau, fval, iterations, calls, warnflag = \
+        fmin(sync_error, tau0, args=(signal1, signal2, time),
+             full_output=True, disp=disp)
+
+    if full_output is True:
+        return tau, fval, warnflag == 0
+    else:
+        return tau
+
+
+def _find_timeshift_worker(args):
+    """Unpacks the arguments for find_timeshift so it can be mapped over a
+    process pool."""
+    signal1, signal2, sample_rate, guess, method = args
+    tau, error, converged = find_timeshift(signal1, signal2, sample_rate,
+                                           guess=guess, method=method,
+                                           full_output=True)
+    return float(tau[0]), error, converged
+
+
+def batch_find_timeshift(signal1s, signal2s, sample_rate, guesses=None,
+                         method='landscape', processes=None):
+    """Returns the time shifts of many pairs of signals, computed in
+    parallel with find_timeshift.
+
+    Parameters
+    ----------
+    signal1s : sequence of array_like or ndarray, shape(m, n)
+        The base signals, one per pair. The signals in a sequence may have
+        different lengths.
+    signal2s : sequence of array_like or ndarray, shape(m, n)
+        The shifted signals, one per pair. Each must have the same length as
+        the corresponding base signal.
+    sample_rate : float or sequence of floats, len(m)
+        The sample rate of the signals, either one for all of the pairs or
+        one for each pair.
+    guesses : sequence of floats, len(m), optional, default=None
+        An initial guess for the time shift of each pair. Entries that are
+        None are found with `method`.
+    method : string, optional, {'landscape'|'xcorr'|'pyramid'},
+             default='landscape'
+        The method find_timeshift uses to find the initial guess.
+    processes : integer, optional, default=None
+        The number of worker processes. If None, the number of CPUs is used.
+        If 1, the pairs are processed serially in this process.
+
+    Returns
+    -------
+    results : ndarray, shape(m,)
+        A structured array with the fields 'tau', the time shift, 'error',
+        the sync_error at tau, and 'converged', the optimizer's convergence
+        flag, for each pair.
+
+    """
+    if len(signal1s) != len(signal2s):
+        raise ValueError('There must be the same number of base and shifted '
+                         'signals.')
+
+    num_pairs = len(signal1s)
+
+    if np.isscalar(sample_rate):
+        sample_rates = [sample_rate] * num_pairs
+    elif len(sample_rate) != num_pairs:
+        raise ValueError('There must be one sample rate per pair of signals.')
+    else:
+        sample_rates = sample_rate
+
+    if guesses is None:
+        guesses = [None] * num_pairs
+    elif len(guesses) != num_pairs:
+        raise ValueError('There must be one guess per pair of signals.')
+
+    args = [(np.asarray(s1), np.asarray(s2), sr, g, method) for
+            s1, s2, sr, g in zip(signal1s, signal2s, sample_rates, guesses)]
+
+    if processes == 1:
+        rows = [_find_timeshift_worker(arg) for arg in args]
+    else:
+        pool = Pool(processes)
+        try:
+            rows = pool.map(_find_timeshift_worker, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    return np.array(rows, dtype=[('tau', float), ('error', float),
+                                 ('converged', bool)])
+
+
+def _xcorr_error(signal1, signal2, max_lag):
+    """Returns the error between two equal length signals for every integer
+    sample lag up to max_lag in both directions.
+
+    The error is the 2-norm of the difference of the overlapping portions of
+    the signals, as in sync_error, but it is found for all lags at once from
+    the cross-correlation and the cumulative energy of each signal.
+
+    Parameters
+    ----------
+    signal1 : ndarray, shape(n,)
+        The base signal.
+    signal2 : ndarray, shape(n,)
+        The signal that lags signal1.
+    max_lag : integer
+        The largest lag, in samples, to compute the error at.
+
+    Returns
+    -------
+    lags : ndarray, shape(2 * max_lag + 1,)
+        The integer lags in samples.
+    error : ndarray, shape(2 * max_lag + 1,)
+        The error at each lag.
+
+    """
+    n = len(signal1)
+    max_lag = min(int(max_lag), n - 1)
+
+    # zero pad to a power of two so the circular correlation is linear
+    nfft = 2 ** int(np.ceil(np.log2(2 * n - 1)))
+    correlation = np.fft.irfft(np.fft.rfft(signal1, nfft) *
+                               np.conj(np.fft.rfft(signal2, nfft)), nfft)
+
+    lags = np.arange(-max_lag, max_lag + 1)
+    # correlation[k] = sum(signal1[n + k] * signal2[n])
+    cross = correlation[lags % nfft]
+
+    # energy of the overlapping portion of each signal, for a positive lag k
+    # signal1[k:] overlaps signal2[:n - k] and vice versa for negative lags
+    energy1 = np.hstack((0.0, np.cumsum(signal1 ** 2)))
+    energy2 = np.hstack((0.0, np.cumsum(signal2 ** 2)))
+    positive = lags >= 0
+    overlap1 = np.where(positive, energy1[-1] - energy1[np.abs(lags)],
+                        energy1[n - np.abs(lags)])
+    overlap2 = np.where(positive, energy2[n - np.abs(lags)],
+                        energy2[-1] - energy2[np.abs(lags)])
+
+    squared_error = overlap1 + overlap2 - 2.0 * cross
+
+    return lags, np.sqrt(np.clip(squared_error, 0.0, np.inf))
+
+
+def _refine_lag(lags, error):
+    """Returns the lag at the minimum of the error, refined to sub-sample
+    accuracy by fitting a parabola through the minimum and its neighbors."""
+    i = np.argmin(error)
+    lag = float(lags[i])
+    if 0 < i < len(error) - 1:
+        left, middle, right = error[i - 1:i + 2] ** 2
+        curvature = left - 2.0 * middle + right
+        if curvature > 0.0:
+            lag += 0.5 * (left - right) / curvature
+    return lag
+
+
+def _lag_error(signal1, signal2, lags):
+    """Returns the error between two equal length signals at each of the
+    given integer lags, see _xcorr_error."""
+    n = len(signal1)
+    error = np.zeros(len(lags))
+    for i, lag in enumerate(lags):
+        if lag >= 0:
+            error[i] = np.linalg.norm(signal1[lag:] - signal2[:n - lag])
+        else:
+            error[i] = np.linalg.norm(signal1[:n + lag] - signal2[-lag:])
+    return error
+
+
+def _pyramid_search(signal1, signal2, sample_rate, min_samples=4096,
+                    window=4):
+    """Returns the error at the integer lags searched on the full resolution
+    level of a decimation pyramid, see pyramid_timeshift."""
+    pyramid1 = _decimation_pyramid(signal1, sample_rate, min_samples)
+    pyramid2 = _decimation_pyramid(signal2, sample_rate, min_samples)
+
+    coarse1, coarse2 = pyramid1[-1][0], pyramid2[-1][0]
+    max_lag = len(coarse1) // 4
+    lags, error = _xcorr_error(coarse1, coarse2, max_lag)
+
+    for (sig1, _), (sig2, _) in reversed(list(zip(pyramid1[:-1],
+                                                  pyramid2[:-1]))):
+        max_lag = len(sig1) // 4
+        center = 2 * lags[np.argmin(error)]
+        # slide the window until the minimum is inside of it, so the
+        # minimum isn't lost if the coarse estimate is off by a sample
+        while True:
+            lags = np.arange(max(center - window, -max_lag),
+                             min(center + window, max_lag) + 1)
+            error = _lag_error(sig1, sig2, lags)
+            i = np.argmin(error)
+            if i == 0 and lags[0] > -max_lag:
+                center = lags[0] - window + 1
+            elif i == len(lags) - 1 and lags[-1] < max_lag:
+                center = lags[-1] + window - 1
+            else:
+                break
+
+    return lags, error
+
+
+def pyramid_timeshift(signal1, signal2, sample_rate, min_samples=4096,
+                      window=4):
+    """Returns the timeshift, tau, of the second signal relative to the
+    first signal found with a coarse to fine search.
+
+    Parameters
+    ----------
+    signal1 : array_like, shape(n, )
+        The base signal.
+    signal2 : array_like, shape(n, )
+        A signal shifted relative to the first signal.
+    sample_rate : integer or float
+        Sample rate of the signals. This should be the same for each signal.
+    min_samples : integer, optional, default=4096
+        The length of the coarsest level of the search.
+    window : integer, optional, default=4
+        The number of samples searched on either side of the estimate from
+        the next coarser level.
+
+    Returns
+    -------
+    tau : float
+        The timeshift between the two signals.
+    bound : float
+        The minimum of the full resolution error lies within tau +/- bound,
+        as it is bracketed by the neighbors of the sample lag with the
+        smallest error.
+
+    Notes
+    -----
+    The signals are repeatedly low pass filtered and decimated by a factor
+    of two until they are shorter than 2 * min_samples. The error is
+    computed at every lag up to a quarter of the coarsest signal's length
+    with an FFT cross-correlation. At each finer level the error is only
+    computed at the lags within `window` samples of twice the previous
+    estimate, and the window is slid until the minimum is inside of it.
+    The full resolution minimum is refined with a parabolic fit. The cost is
+    dominated by the anti-alias filtering, which is O(n). Unlike
+    find_timeshift there is no final optimization with sync_error.
 
-    print "The minimun of the error landscape is {}.".format(tau0)
+    """
+    # raise an error if the signals are not the same length
+    if len(signal1) != len(signal2):
+        raise ValueError('Signals are not the same length!')
 
-    tau, fval = fmin(sync_error, tau0, args=(signal1, signal2, time),
-                     full_output=True, disp=True)[0:2]
+    # subtract the mean and normalize both signals
+    signal1 = normalize(subtract_mean(signal1))
+    signal2 = normalize(subtract_mean(signal2))
 
-    return tau
+    lags, error = _pyramid_search(signal1, signal2, sample_rate,
+                                  min_samples=min_samples, window=window)
+
+    lag = _refine_lag(lags, error)
+    bound = (abs(lag - lags[np.argmin(error)]) + 1.0) / sample_rate
+
+    return lag / sample_rate, bound
+
+
+class DriftTracker(object):
+    """Tracks a slowly varying time shift between two streamed signals by
+    running find_timeshift on sliding windows."""
+
+    dtype = [('time', float), ('tau', float), ('error', float),
+             ('converged', bool)]
+
+    def __init__(self, sample_rate, window, step=None, method='xcorr'):
+        """Returns a DriftTracker object.
+
+        Parameters
+        ----------
+        sample_rate : float
+            The sample rate of both signals in hertz.
+        window : float
+            The duration of each window in seconds.
+        step : float, optional, default=None
+            The time between the starts of consecutive windows in seconds.
+            If None, the windows do not overlap.
+        method : string, optional, {'landscape'|'xcorr'|'pyramid'},
+                 default='xcorr'
+            The method find_timeshift uses to find the shift in the first
+            window. Each later window is warm-started from the previous
+            estimate.
+
+        """
+        self.sample_rate = float(sample_rate)
+        self.window_length = int(round(window * self.sample_rate))
+        if step is None:
+            self.step_length = self.window_length
+        else:
+            self.step_length = int(round(step * self.sample_rate))
+
+        if self.window_length < 4:
+            raise ValueError('The window must span at least four samples.')
+        if not 0 < self.step_length <= self.window_length:
+            raise ValueError('The step must be positive and no longer than '
+                             'the window.')
+
+        self.method = method
+
+        self._buffer1 = np.zeros(0)
+        self._buffer2 = np.zeros(0)
+        # index of the first buffered sample in the full recording
+        self._start = 0
+        self._tau = None
+        self._rows = []
+
+    def update(self, signal1, signal2):
+        """Adds the next chunk of each signal and estimates the time shift
+        for every window that is now complete.
+
+        Parameters
+        ----------
+        signal1 : array_like, shape(n,)
+            The next samples of the base signal.
+        signal2 : array_like, shape(p,)
+            The next samples of the shifted signal. The chunks do not need
+            to be the same length as the signal1 chunks.
+
+        Returns
+        -------
+        shifts : ndarray, shape(q,)
+            A structured array with a row for each newly completed window,
+            see the `shifts` method.
+
+        """
+        self._buffer1 = np.hstack((self._buffer1, signal1))
+        self._buffer2 = np.hstack((self._buffer2, signal2))
+
+        new_rows = []
+        while min(len(self._buffer1), len(self._buffer2)) >= \
+                self.window_length:
+
+            window1 = self._buffer1[:self.window_length]
+            window2 = self._buffer2[:self.window_length]
+
+            tau, error, converged = find_timeshift(window1, window2,
+                                                   self.sample_rate,
+                                                   guess=self._tau,
+                                                   method=self.method,
+                                                   full_output=True)
+            self._tau = float(tau[0])
+
+            center = (self._start + 0.5 * (self.window_length - 1)) / \
+                self.sample_rate
+            new_rows.append((center, self._tau, error, converged))
+
+            # drop the samples that no later window needs
+            self._buffer1 = self._buffer1[self.step_length:]
+            self._buffer2 = self._buffer2[self.step_length:]
+            self._start += self.step_length
+
+        self._rows.extend(new_rows)
+
+        return np.array(new_rows, dtype=self.dtype)
+
+    def shifts(self):
+        """Returns the table of time shifts estimated so far.
+
+        Returns
+        -------
+        shifts : ndarray, shape(q,)
+            A structured array with a row per window and the fields 'time',
+            the time at the center of the window, 'tau', the time shift in
+            the window, 'error', the sync_error at tau, and 'converged', the
+            optimizer's convergence flag.
+
+        """
+        return np.array(self._rows, dtype=self.dtype)
 
 
 def truncate_data(tau, signal1, signal2, sample_rate):
@@ -173,38 +676,289 @@ def truncate_data(tau, signal1, signal2, sample_rate):
         The truncated time series.
 
     '''
-    t = time_vector(len(signal1), sample_rate)
+    t = time_vector(len(signal1), sample_rate, lazy=True)
 
     # shift the first signal
     t1 = t - tau
     t2 = t
 
     # make the common time interval
-    common_interval = t2[np.nonzero(t2 < t1[-1])]
+    stop = t2.searchsorted(t1[-1], side='left')
+    common_interval = t2[:stop]
+
+    truncated1 = _interp(common_interval, t1, signal1)
+    truncated2 = np.asarray(signal2)[:stop]
+
+    return truncated1, truncated2
+
+
+def _decimation_pyramid(signal, sample_rate, min_samples):
+    """Returns successively decimated copies of a signal. Each level is low
+    pass filtered below its Nyquist frequency and then down sampled by a
+    factor of two.
+
+    Parameters
+    ----------
+    signal : ndarray, shape(n,)
+        The signal.
+    sample_rate : float
+        The sample rate of the signal in hertz.
+    min_samples : integer
+        The signal is not decimated below this number of samples.
+
+    Returns
+    -------
+    levels : list of tuples
+        The (signal, sample_rate) pairs ordered from the full resolution
+        signal to the coarsest level.
+
+    """
+    levels = [(signal, float(sample_rate))]
+    while len(levels[-1][0]) // 2 >= min_samples:
+        previous, rate = levels[-1]
+        # cut off at 80% of the new Nyquist frequency to avoid aliasing
+        filtered = butterworth(previous, 0.2 * rate, rate, order=8)
+        levels.append((filtered[::2], rate / 2.0))
+    return levels
+
+
+def warp_error(tau, rate, signal1, signal2, time):
+    """Returns the error between two signal time histories given a time
+    shift, tau, and a clock rate ratio, rate. Signal 2 at time t is compared
+    to signal 1 at time rate * t + tau.
+
+    Parameters
+    ----------
+    tau : float
+        The time shift at the start of the signals.
+    rate : float
+        The ratio of the sample rate of signal 2 to that of signal 1.
+    signal1 : ndarray, shape(n,)
+        The signal that will be interpolated.
+    signal2 : ndarray, shape(n,)
+        The signal that will be warped to syncronize with signal 1.
+    time : ndarray, shape(n,) or TimeBase
+        The time vector for the two signals.
+
+    Returns
+    -------
+    error : float
+        Error between the two signals for the given tau and rate. This is
+        the same as sync_error(tau, ...) if rate is 1.0, except that samples
+        are dropped from both ends of the overlap if needed.
+
+    """
+    warped_time = time * rate + tau
+
+    # the overlap is a range of samples as the warped times are sorted
+    start = warped_time.searchsorted(time[0], side='left')
+    stop = warped_time.searchsorted(time[-1], side='right')
+    if start >= stop:
+        return np.inf
+
+    sig1_on_interval = _interp(warped_time[start:stop], time, signal1)
+
+    return np.linalg.norm(sig1_on_interval - signal2[start:stop])
+
+
+def _interp(x, time, values):
+    """Returns numpy.interp(x, time, values) for time arrays or TimeBase
+    objects, see TimeBase.interp."""
+    if isinstance(time, TimeBase):
+        return time.interp(x, values)
+    if isinstance(x, TimeBase):
+        x = x.values()
+    return np.interp(x, time, values)
+
+
+def find_timewarp(signal1, signal2, sample_rate, max_rate_error=0.01,
+                  guess=None, min_samples=4096):
+    """Returns the time shift, tau, and the clock rate ratio, rate, of the
+    second signal relative to the first signal, i.e. signal2(t) =
+    signal1(rate * t + tau).
+
+    Parameters
+    ----------
+    signal1 : array_like, shape(n, )
+        The base signal.
+    signal2 : array_like, shape(n, )
+        A signal shifted and stretched relative to the first signal.
+    sample_rate : integer or float
+        The nominal sample rate of the signals. This should be the same for
+        each signal.
+    max_rate_error : float, optional, default=0.01
+        The largest relative difference in the clock rates that is searched
+        for when no guess is given.
+    guess : tuple of floats, optional, default=None
+        If you've got a good guess for (tau, rate) then supply it here.
+    min_samples : integer, optional, default=4096
+        The length of the coarsest level of the decimated search.
+
+    Returns
+    -------
+    tau : float
+        The time shift at the start of the signals.
+    rate : float
+        The ratio of the clock rate of signal 2 to that of signal 1.
+
+    Notes
+    -----
+    The signals are repeatedly low pass filtered and decimated by a factor
+    of two until they are shorter than 2 * min_samples. The initial guess is
+    found on the coarsest level with cross-correlations over a grid of
+    rates, and the estimate is then refined with a Nelder-Mead search on
+    each level from the coarsest to the full resolution.
+
+    """
+    # raise an error if the signals are not the same length
+    if len(signal1) != len(signal2):
+        raise ValueError('Signals are not the same length!')
+
+    # subtract the mean and normalize both signals
+    signal1 = normalize(subtract_mean(signal1))
+    signal2 = normalize(subtract_mean(signal2))
+
+    pyramid1 = _decimation_pyramid(signal1, sample_rate, min_samples)
+    pyramid2 = _decimation_pyramid(signal2, sample_rate, min_samples)
+
+    if guess is None:
+        coarse1, coarse_rate = pyramid1[-1]
+        coarse2 = pyramid2[-1][0]
+        time = time_vector(len(coarse1), coarse_rate, lazy=True)
+
+        # space the rates so the drift across the record changes by about
+        # one coarse sample between them
+        num = int(np.ceil(2.0 * max_rate_error * len(coarse1))) + 1
+        best = (np.inf, 0.0, 1.0)
+        for rate in np.linspace(1.0 - max_rate_error, 1.0 + max_rate_error,
+                                num=num):
+            # signal1(rate * t + tau) = stretched(t + tau / rate)
+            stretched = _interp(time * rate, time, coarse1)
+            lags, error = _xcorr_error(stretched, coarse2, len(time) // 4)
+            i = np.argmin(error)
+            if error[i] < best[0]:
+                best = (error[i], rate * lags[i] / coarse_rate, rate)
+        tau, rate = best[1:]
+    else:
+        tau, rate = guess
+
+    # The search is done on the shifts at the start and at the end of the
+    # record as these have the same scale, which suits fmin's initial
+    # simplex.
+    for (sig1, level_rate), (sig2, _) in reversed(list(zip(pyramid1,
+                                                           pyramid2))):
+        time = time_vector(len(sig1), level_rate, lazy=True)
+        duration = time[-1]
+
+        def error(x):
+            return warp_error(x[0], 1.0 + (x[1] - x[0]) / duration, sig1,
+                              sig2, time)
+
+        x = fmin(error, [tau, tau + (rate - 1.0) * duration],
+                 xtol=0.1 / level_rate, disp=False)
+        tau, rate = x[0], 1.0 + (x[1] - x[0]) / duration
+
+    return tau, rate
+
+
+def truncate_warped_data(tau, rate, signal1, signal2, sample_rate):
+    """Returns the truncated vectors with respect to the time shift tau and
+    the clock rate ratio rate. It assumes you've found them with
+    find_timewarp or something similar.
+
+    Parameters
+    ----------
+    tau : float
+        The time shift at the start of the signals.
+    rate : float
+        The ratio of the clock rate of signal 2 to that of signal 1.
+    signal1 : array_like, shape(n, )
+        A time series, this is resampled onto the time base of signal 2.
+    signal2 : array_like, shape(n, )
+        A time series.
+    sample_rate : integer
+        The nominal sample rate of the two signals.
+
+    Returns
+    -------
+    truncated1 : ndarray, shape(m, )
+        The resampled and truncated time series.
+    truncated2 : ndarray, shape(m, )
+        The truncated time series.
+
+    """
+    t = time_vector(len(signal1), sample_rate, lazy=True)
 
-    truncated1 = np.interp(common_interval, t1, signal1)
-    truncated2 = signal2[np.nonzero(t2 <= common_interval[-1])]
+    warped_time = t * rate + tau
+
+    # the common time interval
+    start = warped_time.searchsorted(t[0], side='left')
+    stop = warped_time.searchsorted(t[-1], side='right')
+
+    truncated1 = _interp(warped_time[start:stop], t, signal1)
+    truncated2 = np.asarray(signal2)[start:stop]
 
     return truncated1, truncated2
 
 
-def least_squares_variance(A, sum_of_residuals):
+def least_squares_variance(A, sum_of_residuals, R=None, svd=None,
+                           diagonal=False, indices=None, probes=None,
+                           block_size=256):
     """Returns the variance in the ordinary least squares fit and the
     covariance matrix of the estimated parameters.
 
     Parameters
     ----------
-    A : ndarray, shape(n,d)
+    A : ndarray or sparse matrix, shape(n,d)
         The left hand side matrix in Ax=B.
     sum_of_residuals : float
         The sum of the residuals (residual sum of squares).
+    R : ndarray, shape(d,d), optional, default=None
+        The upper triangular factor of A = QR, e.g. from
+        numpy.linalg.qr(A, mode='r'), or equivalently the Cholesky factor of
+        A^T A = R^T R. If neither R nor svd is given, it is computed. Only
+        used for dense A.
+    svd : tuple of ndarrays, optional, default=None
+        The singular values, s, and right singular vectors, Vt, of A, as
+        (s, Vt) or as (U, s, Vt) returned by numpy.linalg.svd(A,
+        full_matrices=False). The singular values from numpy.linalg.lstsq
+        alone are not enough. Only used for dense A.
+    diagonal : boolean, optional, default=False
+        If true, only the diagonal of the covariance, i.e. the variances of
+        the parameters, is computed and returned.
+    indices : array_like of ints, shape(k,), optional, default=None
+        If given, only the covariance of these parameters, shape(k,k), or
+        their variances, shape(k,), if diagonal is true, are returned.
+    probes : int or ndarray, shape(d,p), optional, default=None
+        For sparse A, estimate the variances of all parameters with this
+        many random +/-1 probing vectors, or with the given probing vectors,
+        instead of computing them exactly. Only used if diagonal is true and
+        indices is None.
+    block_size : int, optional, default=256
+        For sparse A, the number of right hand sides solved at once.
 
     Returns
     -------
     variance : float
         The variance of the fit.
-    covariance : ndarray, shape(d,d)
-        The covariance of x in Ax = b.
+    covariance : ndarray or sparse matrix, shape(d,d), shape(d,), shape(k,k)
+    or shape(k,)
+        The covariance of x in Ax = b, or only its diagonal.
+
+    Notes
+    -----
+    The covariance is variance * (A^T A)^-1. For dense A this is computed
+    from R^-1 R^-T or V S^-2 V^T, which avoids forming A^T A and squaring
+    its condition number.
+
+    For sparse A, A^T A is factored once with a sparse LU decomposition and
+    the requested parts of its inverse are found by solving for blocks of
+    unit vectors, so only block_size dense columns are held at a time. The
+    probing estimate of the variances is sum(v * (A^T A)^-1 v) / sum(v * v)
+    over the probing vectors v. The full covariance of a sparse A is the
+    dense inverse in sparse storage, so it is only computed for up to 2000
+    parameters; request the diagonal or a subset of indices for larger
+    problems.
 
     """
     # I am pretty sure that the residuals from numpy.linalg.lstsq is the SSE
@@ -213,36 +967,259 @@ def least_squares_variance(A, sum_of_residuals):
     degrees_of_freedom = (A.shape[0] - A.shape[1])
     variance = sum_of_residuals / degrees_of_freedom
 
-    # There may be a way to use the pinv here for more efficient
-    # computations. (A^T A)^-1 A^T = np.linalg.pinv(A) so np.linalg.pinv(A)
-    # (A^T)^-1 ... or maybe not.
     if sparse.issparse(A):
-        inv = sparse.linalg.inv
-        prod = A.T * A
+        return variance, variance * _sparse_inverse_normal(
+            A, diagonal, indices, probes, block_size)
+
+    if svd is not None:
+        s, Vt = svd[-2:]
+        # (A^T A)^-1 = (V S^-1) (V S^-1)^T
+        factor = Vt.T / s
     else:
-        inv = np.linalg.inv
-        prod = np.dot(A.T, A)
+        if R is None:
+            R = np.linalg.qr(A, mode='r')
+        # (A^T A)^-1 = R^-1 R^-T
+        factor = solve_triangular(R, np.eye(R.shape[0]))
 
-    covariance = variance * inv(prod)
+    if indices is not None:
+        factor = factor[np.asarray(indices)]
+
+    if diagonal:
+        covariance = variance * np.sum(factor ** 2, axis=1)
+    else:
+        covariance = variance * np.dot(factor, factor.T)
 
     return variance, covariance
 
 
-def coefficient_of_determination(measured, predicted):
+def _sparse_inverse_normal(A, diagonal, indices, probes, block_size):
+    """Returns the requested part of (A^T A)^-1 for a sparse A, see
+    least_squares_variance."""
+    normal = (A.T * A).tocsc()
+    num_parameters = normal.shape[0]
+
+    if not diagonal and indices is None:
+        if num_parameters > _SPARSE_INVERSE_MAX_PARAMETERS:
+            raise ValueError('The full covariance of {} parameters is a '
+                             'dense {} by {} matrix, use diagonal=True or '
+                             'indices instead.'.format(num_parameters,
+                                                       num_parameters,
+                                                       num_parameters))
+        return sparse.linalg.inv(normal)
+
+    factorization = splu(normal, permc_spec='MMD_AT_PLUS_A')
+
+    def solve_columns(columns, rows):
+        # solves for the given unit vector columns of the inverse and keeps
+        # the given rows of them, block by block
+        result = np.empty((len(rows), len(columns)))
+        for start in range(0, len(columns), block_size):
+            block = columns[start:start + block_size]
+            rhs = np.zeros((num_parameters, len(block)))
+            rhs[block, np.arange(len(block))] = 1.0
+            result[:, start:start + len(block)] = \
+                factorization.solve(rhs)[rows]
+        return result
+
+    def solve_diagonal(columns):
+        # only holds a block_size square block of the inverse at a time
+        inverse_diagonal = np.empty(len(columns))
+        for start in range(0, len(columns), block_size):
+            block = columns[start:start + block_size]
+            inverse_diagonal[start:start + len(block)] = np.diag(
+                solve_columns(block, block))
+        return inverse_diagonal
+
+    if indices is not None:
+        indices = np.asarray(indices)
+        if diagonal:
+            return solve_diagonal(indices)
+        return solve_columns(indices, indices)
+
+    if probes is None:
+        return solve_diagonal(np.arange(num_parameters))
+
+    if np.isscalar(probes):
+        probes = np.random.choice([-1.0, 1.0], size=(num_parameters,
+                                                     int(probes)))
+    numerator = np.zeros(num_parameters)
+    for start in range(0, probes.shape[1], block_size):
+        block = probes[:, start:start + block_size]
+        numerator += np.sum(block * factorization.solve(block), axis=1)
+    return numerator / np.sum(probes ** 2, axis=1)
+
+
+class RecursiveLeastSquares(object):
+    """Updates the ordinary least squares solution of Ax = b, and its
+    variance and covariance, as rows of A and b arrive."""
+
+    def __init__(self, num_parameters, forgetting_factor=1.0,
+                 initial_covariance=1e6, initial_parameters=None):
+        """Returns a RecursiveLeastSquares object.
+
+        Parameters
+        ----------
+        num_parameters : int
+            The number of parameters, d, i.e. the number of columns in A.
+        forgetting_factor : float, optional, default=1.0
+            The weight, 0 < lambda <= 1, applied to all previous rows each
+            time a new row arrives. Rows that are k rows old have the weight
+            lambda**k, so values less than one track parameters that vary
+            slowly.
+        initial_covariance : float or ndarray, shape(d,d), optional,
+        default=1e6
+            The initial value of (A^T A)^-1. Large values give little weight
+            to the initial parameters and the solution approaches the batch
+            least squares solution.
+        initial_parameters : array_like, shape(d,), optional, default=None
+            The initial estimate of x. Defaults to zeros.
+
+        """
+        if not 0.0 < forgetting_factor <= 1.0:
+            raise ValueError('The forgetting factor must be in (0, 1].')
+
+        self.forgetting_factor = float(forgetting_factor)
+
+        if initial_parameters is None:
+            self.parameters = np.zeros(num_parameters)
+        else:
+            self.parameters = np.array(initial_parameters, dtype=float)
+
+        if np.isscalar(initial_covariance):
+            self._P = initial_covariance * np.eye(num_parameters)
+        else:
+            self._P = np.array(initial_covariance, dtype=float)
+
+        self.sum_of_residuals = 0.0
+        # the sum of the row weights, i.e. the effective number of rows
+        self._weight = 0.0
+        self.count = 0
+
+    def update(self, A, b):
+        """Adds one or more rows to the least squares problem.
+
+        Parameters
+        ----------
+        A : array_like, shape(d,) or shape(m,d)
+            A row, or m rows, of the left hand side matrix in Ax=b.
+        b : float or array_like, shape(m,)
+            The matching right hand side values.
+
+        Returns
+        -------
+        self : RecursiveLeastSquares
+            This object.
+
+        Notes
+        -----
+        Blocks of up to d rows are added at once with the matrix inversion
+        lemma, which costs O(d^2) per row.
+
+        """
+        A = np.atleast_2d(np.asarray(A, dtype=float))
+        b = np.atleast_1d(np.asarray(b, dtype=float))
+
+        if A.shape[1] != len(self.parameters) or A.shape[0] != len(b):
+            msg = 'A must have shape(m, {}) and b shape(m,).'
+            raise ValueError(msg.format(len(self.parameters)))
+
+        block_size = len(self.parameters)
+        for start in range(0, len(b), block_size):
+            self._update_block(A[start:start + block_size],
+                               b[start:start + block_size])
+
+        return self
+
+    def _update_block(self, A, b):
+        num_rows = len(b)
+        # the most recent row has weight 1
+        weights = self.forgetting_factor ** np.arange(num_rows - 1, -1, -1)
+        discount = self.forgetting_factor ** num_rows
+
+        P = self._P / discount
+        PAt = np.dot(P, A.T)
+        S = np.dot(A, PAt)
+        S[np.diag_indices_from(S)] += 1.0 / weights
+
+        error = b - np.dot(A, self.parameters)
+        gain = np.linalg.solve(S, PAt.T).T
+
+        self.parameters = self.parameters + np.dot(gain, error)
+        self._P = P - np.dot(gain, PAt.T)
+        # keep P symmetric against round off
+        self._P = (self._P + self._P.T) / 2.0
+
+        self.sum_of_residuals = (discount * self.sum_of_residuals +
+                                 np.dot(error, np.linalg.solve(S, error)))
+        self._weight = discount * self._weight + weights.sum()
+        self.count += num_rows
+
+    def covariance(self, diagonal=False):
+        """Returns the variance of the fit and the covariance of the
+        parameters, as least_squares_variance does.
+
+        Parameters
+        ----------
+        diagonal : boolean, optional, default=False
+            If true, only the variances of the parameters are returned.
+
+        Returns
+        -------
+        variance : float
+            The variance of the fit.
+        covariance : ndarray, shape(d,d) or shape(d,)
+            The covariance of x in Ax = b, or only its diagonal.
+
+        """
+        degrees_of_freedom = self._weight - len(self.parameters)
+        if degrees_of_freedom <= 0:
+            raise ValueError('There must be more rows than parameters.')
+        variance = self.sum_of_residuals / degrees_of_freedom
+        if diagonal:
+            return variance, variance * np.diag(self._P).copy()
+        else:
+            return variance, variance * self._P
+
+    def get_state(self):
+        """Returns a dictionary with a copy of the internal state, e.g. to
+        save a checkpoint with numpy.savez."""
+        return {'parameters': self.parameters.copy(),
+                'P': self._P.copy(),
+                'sum_of_residuals': self.sum_of_residuals,
+                'weight': self._weight,
+                'count': self.count,
+                'forgetting_factor': self.forgetting_factor}
+
+    def set_state(self, state):
+        """Restores the internal state from a dictionary returned by
+        get_state."""
+        self.parameters = np.array(state['parameters'], dtype=float)
+        self._P = np.array(state['P'], dtype=float)
+        self.sum_of_residuals = float(state['sum_of_residuals'])
+        self._weight = float(state['weight'])
+        self.count = int(state['count'])
+        self.forgetting_factor = float(state['forgetting_factor'])
+
+
+def coefficient_of_determination(measured, predicted, axis=None):
     """Computes the coefficient of determination with respect to a measured
     and predicted array.
 
     Parameters
     ----------
-    measured : array_like, shape(n,)
+    measured : array_like, shape(n,) or shape(n, ...)
         The observed or measured values.
-    predicted : array_like, shape(n,)
+    predicted : array_like, shape(n,) or shape(n, ...)
         The values predicted by a model.
+    axis : int, optional, default=None
+        The axis along which the samples lie, e.g. axis=0 for an array with
+        a column per channel or an array of shape(n, channels, trials). If
+        None, all of the values are used.
 
     Returns
     -------
-    r_squared : float
-       The coefficient of determination.
+    r_squared : float or ndarray
+       The coefficient of determination, for each column if axis is given.
 
     Notes
     -----
@@ -264,34 +1241,40 @@ def coefficient_of_determination(measured, predicted):
     """
     # 2-norm => np.sqrt(np.sum(measured - predicted)**2))
 
-    numerator = np.linalg.norm(measured - predicted) ** 2
-    denominator = np.linalg.norm(measured - measured.mean()) ** 2
+    measured = np.asarray(measured)
+    predicted = np.asarray(predicted)
+
+    numerator = np.sum((measured - predicted) ** 2, axis=axis)
+    denominator = np.sum((measured - _mean(measured, axis)) ** 2, axis=axis)
 
     r_squared = 1.0 - numerator / denominator
 
     return r_squared
 
 
-def fit_goodness(ym, yp):
+def fit_goodness(ym, yp, axis=None):
     '''
     Calculate the goodness of fit.
 
     Parameters
     ----------
-    ym : ndarray, shape(n,)
+    ym : ndarray, shape(n,) or shape(n, ...)
         The vector of measured values.
-    yp : ndarry, shape(n,)
+    yp : ndarry, shape(n,) or shape(n, ...)
         The vector of predicted values.
+    axis : int, optional, default=None
+        The axis along which the samples lie, e.g. axis=0 for an array with
+        a column per channel. If None, all of the values are used.
 
     Returns
     -------
-    rsq : float
+    rsq : float or ndarray
         The r squared value of the fit.
-    SSE : float
+    SSE : float or ndarray
         The error sum of squares.
-    SST : float
+    SST : float or ndarray
         The total sum of squares.
-    SSR : float
+    SSR : float or ndarray
         The regression sum of squares.
 
     Notes
@@ -300,17 +1283,343 @@ def fit_goodness(ym, yp):
     SST = SSR + SSE
 
     '''
+    ym = np.asarray(ym)
+    yp = np.asarray(yp)
 
-    ym_bar = np.mean(ym)
-    SSR = sum((yp - ym_bar) ** 2)
-    SST = sum((ym - ym_bar) ** 2)
+    ym_bar = _mean(ym, axis)
+    SSR = np.sum((yp - ym_bar) ** 2, axis=axis)
+    SST = np.sum((ym - ym_bar) ** 2, axis=axis)
     SSE = SST - SSR
     rsq = SSR / SST
 
     return rsq, SSE, SST, SSR
 
 
-def spline_over_nan(x, y):
+def _mean(data, axis):
+    """Returns the mean of data along axis that broadcasts against data."""
+    if axis is None:
+        return data.mean()
+    return np.expand_dims(data.mean(axis=axis), axis)
+
+
+class RunningFitGoodness(object):
+    """Accumulates the sums of squares for coefficient_of_determination and
+    fit_goodness from measured and predicted values that arrive in chunks,
+    e.g. from data that doesn't fit in memory."""
+
+    def __init__(self):
+        """Returns a RunningFitGoodness object. The samples lie along the
+        first axis of each chunk and any other axes are treated as
+        independent columns, as with axis=0 in fit_goodness."""
+        self.count = 0
+        # the means and the sums of the squared deviations from the means
+        # of the measured and predicted values, and the sum of the squared
+        # residuals
+        self._measured_mean = 0.0
+        self._measured_m2 = 0.0
+        self._predicted_mean = 0.0
+        self._predicted_m2 = 0.0
+        self._residuals = 0.0
+
+    def update(self, measured, predicted):
+        """Adds the next chunk of measured and predicted values.
+
+        Parameters
+        ----------
+        measured : array_like, shape(m,) or shape(m, ...)
+            The next observed or measured values.
+        predicted : array_like, shape(m,) or shape(m, ...)
+            The matching values predicted by a model.
+
+        Returns
+        -------
+        self : RunningFitGoodness
+            This object.
+
+        """
+        measured = np.asarray(measured, dtype=float)
+        predicted = np.asarray(predicted, dtype=float)
+        if measured.shape != predicted.shape:
+            raise ValueError('measured and predicted must have the same '
+                             'shape.')
+        if len(measured) == 0:
+            return self
+
+        chunk = RunningFitGoodness()
+        chunk.count = len(measured)
+        chunk._measured_mean = measured.mean(axis=0)
+        chunk._measured_m2 = np.sum((measured - chunk._measured_mean) ** 2,
+                                    axis=0)
+        chunk._predicted_mean = predicted.mean(axis=0)
+        chunk._predicted_m2 = np.sum((predicted - chunk._predicted_mean) **
+                                     2, axis=0)
+        chunk._residuals = np.sum((measured - predicted) ** 2, axis=0)
+
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """Adds the values accumulated by another RunningFitGoodness, e.g.
+        one computed on a different part of the data by another worker, to
+        this one.
+
+        Parameters
+        ----------
+        other : RunningFitGoodness
+            An object that accumulated values with the same column shape.
+
+        Returns
+        -------
+        self : RunningFitGoodness
+            This object.
+
+        Notes
+        -----
+        The means and squared deviations are combined with the pairwise
+        update of Chan et al., which, unlike accumulating the raw sums of
+        squares, doesn't lose precision when the mean is large compared to
+        the deviations.
+
+        """
+        if other.count == 0:
+            return self
+
+        count = self.count + other.count
+        weight = float(other.count) / count
+
+        def combine(mean, m2, other_mean, other_m2):
+            delta = other_mean - mean
+            return (mean + delta * weight,
+                    m2 + other_m2 + delta ** 2 * self.count * weight)
+
+        self._measured_mean, self._measured_m2 = combine(
+            self._measured_mean, self._measured_m2, other._measured_mean,
+            other._measured_m2)
+        self._predicted_mean, self._predicted_m2 = combine(
+            self._predicted_mean, self._predicted_m2, other._predicted_mean,
+            other._predicted_m2)
+        self._residuals = self._residuals + other._residuals
+        self.count = count
+
+        return self
+
+    def coefficient_of_determination(self):
+        """Returns the coefficient of determination of the accumulated
+        values, see coefficient_of_determination."""
+        return 1.0 - self._residuals / self._measured_m2
+
+    def fit_goodness(self):
+        """Returns the r squared value, SSE, SST and SSR of the accumulated
+        values, see fit_goodness."""
+        # sum((yp - mean(ym))**2) = sum((yp - mean(yp))**2) +
+        #                           n * (mean(yp) - mean(ym))**2
+        SSR = (self._predicted_m2 + self.count *
+               (self._predicted_mean - self._measured_mean) ** 2)
+        SST = self._measured_m2
+        SSE = SST - SSR
+        rsq = SSR / SST
+
+        return rsq, SSE, SST, SSR
+
+
+def bootstrap(statistic, data, num_replicates=1000, block_size=256,
+              processes=None, seed=None):
+    """Returns bootstrap replicates of a statistic of the rows of some data.
+
+    Parameters
+    ----------
+    statistic : string or callable
+        Either 'coefficient_of_determination', with data (measured,
+        predicted) as in coefficient_of_determination with axis=0, or
+        'least_squares' or 'least_squares_normal', with data (A, b) and the
+        solution x of Ax = b as the statistic, see the notes. A callable is
+        called as statistic(counts, *data), where counts, shape(k, n), holds
+        the number of times each row is drawn in each of k resamples, and
+        must return an array of shape(k, ...). It must be picklable, i.e. a
+        module level function, if processes isn't 1.
+    data : tuple of ndarrays, each shape(n, ...)
+        The arrays whose rows are resampled together.
+    num_replicates : integer, optional, default=1000
+        The number of resamples.
+    block_size : integer, optional, default=256
+        The number of resamples that are drawn and evaluated at once.
+    processes : integer, optional, default=None
+        The number of worker processes. If None, the number of CPUs is used.
+        If 1, the replicates are computed serially in this process.
+    seed : integer, optional, default=None
+        The seed of the random number generator. The replicates only depend
+        on the seed and the block size, not on the number of processes.
+
+    Returns
+    -------
+    replicates : ndarray, shape(num_replicates, ...)
+        The statistic of each resample.
+
+    Notes
+    -----
+    Each block of resamples is drawn with its own numpy.random.RandomState,
+    seeded from one generator seeded with `seed`. The resampled rows are
+    never copied; the coefficient of determination is computed from the
+    weighted sums of per row terms, counts times a precomputed feature
+    array.
+
+    'least_squares' solves each resample as a least squares problem with
+    the rows of A and b weighted by the square root of their counts, which
+    is as accurate as numpy.linalg.lstsq. 'least_squares_normal' instead
+    solves the resampled normal equations, A^T W A x = A^T W b, for a whole
+    block at once, which is much faster for many replicates but squares the
+    condition number of A, so only use it for well conditioned A.
+
+    """
+    data = tuple(np.asarray(array) for array in data)
+    num_samples = len(data[0])
+    if any(len(array) != num_samples for array in data):
+        raise ValueError('All of the data must have the same number of rows.')
+
+    if not (callable(statistic) or statistic in _BOOTSTRAP_STATISTICS or
+            statistic in _BOOTSTRAP_FUNCTIONS):
+        raise ValueError('{} is not a valid statistic.'.format(statistic))
+
+    num_blocks = -(-num_replicates // block_size)
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1,
+                                                size=num_blocks)
+    sizes = [min(block_size, num_replicates - i * block_size) for i in
+             range(num_blocks)]
+    blocks = list(zip(seeds, sizes))
+
+    if processes == 1:
+        results = [_bootstrap_worker((statistic, data, blocks, block_size))]
+    else:
+        # each worker gets a contiguous share of the blocks, so the data is
+        # only sent to it once
+        num_workers = min(processes or cpu_count(), num_blocks)
+        pool = Pool(num_workers)
+        try:
+            shares = np.array_split(np.arange(num_blocks), num_workers)
+            args = [(statistic, data, [blocks[i] for i in share], block_size)
+                    for share in shares]
+            results = pool.map(_bootstrap_worker, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    return np.concatenate(results)
+
+
+def _bootstrap_worker(args):
+    """Computes the statistic for a list of (seed, size) blocks of
+    resamples, see bootstrap."""
+    statistic, data, blocks, block_size = args
+    num_samples = len(data[0])
+
+    if callable(statistic) or statistic in _BOOTSTRAP_FUNCTIONS:
+        function = _BOOTSTRAP_FUNCTIONS.get(statistic, statistic)
+        evaluate = lambda counts: function(counts, *data)
+    else:
+        features, finish = _BOOTSTRAP_STATISTICS[statistic]
+        feature_array = features(*data)
+        evaluate = lambda counts: finish(np.dot(counts, feature_array),
+                                         *data)
+
+    counts = np.empty((block_size, num_samples))
+    offsets = num_samples * np.arange(block_size)[:, np.newaxis]
+    results = []
+    for seed, size in blocks:
+        indices = np.random.RandomState(seed).randint(0, num_samples,
+                                                      size=(size,
+                                                            num_samples))
+        indices += offsets[:size]
+        counts[:size] = np.bincount(indices.ravel(),
+                                    minlength=size * num_samples).reshape(
+                                        size, num_samples)
+        results.append(evaluate(counts[:size]))
+
+    return np.concatenate(results)
+
+
+def _r_squared_features(measured, predicted):
+    """Returns the per row terms whose sums give the coefficient of
+    determination."""
+    measured = measured.reshape(len(measured), -1)
+    predicted = predicted.reshape(len(predicted), -1)
+    # centering on the full sample mean avoids cancellation in the total sum
+    # of squares
+    centered = measured - measured.mean(axis=0)
+    return np.hstack(((measured - predicted) ** 2, centered, centered ** 2))
+
+
+def _r_squared_from_sums(sums, measured, predicted):
+    num_samples = len(measured)
+    error, total, total_squares = np.split(sums, 3, axis=1)
+    r_squared = 1.0 - error / (total_squares - total ** 2 / num_samples)
+    return r_squared.reshape((len(sums),) + measured.shape[1:])
+
+
+def _normal_equation_features(A, b):
+    """Returns the per row terms whose sums give A^T A and A^T b."""
+    outer = A[:, :, np.newaxis] * A[:, np.newaxis, :]
+    return np.hstack((outer.reshape(len(A), -1), A * b[:, np.newaxis]))
+
+
+def _parameters_from_sums(sums, A, b):
+    num_parameters = A.shape[1]
+    normal = sums[:, :num_parameters ** 2].reshape(-1, num_parameters,
+                                                   num_parameters)
+    return np.linalg.solve(normal, sums[:, num_parameters ** 2:])
+
+
+def _weighted_least_squares(counts, A, b):
+    """Returns the least squares solution of each resample of Ax = b, with
+    the rows weighted by the square root of their counts."""
+    weighted_A = np.empty_like(A, dtype=float)
+    weighted_b = np.empty_like(b, dtype=float)
+    parameters = np.empty((len(counts), A.shape[1]))
+    for x, row_counts in zip(parameters, counts):
+        weights = np.sqrt(row_counts)
+        np.multiply(A, weights[:, np.newaxis], out=weighted_A)
+        np.multiply(b, weights, out=weighted_b)
+        x[:] = np.linalg.lstsq(weighted_A, weighted_b)[0]
+    return parameters
+
+
+# the statistics computed from the count weighted sums of per row features
+_BOOTSTRAP_STATISTICS = {
+    'coefficient_of_determination': (_r_squared_features,
+                                     _r_squared_from_sums),
+    'least_squares_normal': (_normal_equation_features,
+                             _parameters_from_sums),
+}
+
+# the statistics computed from the counts directly
+_BOOTSTRAP_FUNCTIONS = {
+    'least_squares': _weighted_least_squares,
+}
+
+
+def confidence_interval(replicates, confidence=0.95):
+    """Returns the percentile bootstrap confidence interval.
+
+    Parameters
+    ----------
+    replicates : ndarray, shape(m, ...)
+        The bootstrap replicates of a statistic, e.g. from bootstrap.
+    confidence : float, optional, default=0.95
+        The probability covered by the interval.
+
+    Returns
+    -------
+    lower : ndarray, shape(...)
+        The lower bound of the interval.
+    upper : ndarray, shape(...)
+        The upper bound of the interval.
+
+    """
+    tail = 50.0 * (1.0 - confidence)
+    lower, upper = np.percentile(replicates, [tail, 100.0 - tail], axis=0)
+    return lower, upper
+
+
+def spline_over_nan(x, y, method='global', margin=10, max_gap=None,
+                    full_output=False):
     """
     Returns a vector of which a cubic spline is used to fill in gaps in the
     data from nan values.
@@ -319,14 +1628,30 @@ def spline_over_nan(x, y):
     ----------
     x : ndarray, shape(n,)
         This x values should not contain nans.
-    y : ndarray, shape(n,)
-        The y values may contain nans.
+    y : ndarray, shape(n,) or shape(n,m)
+        The y values may contain nans. Each column of a 2D array is filled
+        independently.
+    method : string, optional, {'global'|'local'}, default='global'
+        'global' fits one spline through all of the valid samples. 'local'
+        fits a small spline through the samples on either side of each gap,
+        which is much faster for long signals with a few short gaps.
+    margin : integer, optional, default=10
+        The number of samples on either side of a gap that the 'local'
+        splines are fit to.
+    max_gap : integer, optional, default=None
+        Gaps with more samples than this are left as nans.
+    full_output : boolean, optional, default=False
+        If true, the gaps that weren't filled are also returned.
 
     Returns
     -------
-    ySpline : ndarray, shape(n,)
+    ySpline : ndarray, shape(n,) or shape(n,m)
         The splined y values. If `y` doesn't contain any nans then `ySpline` is
         `y`.
+    unfilled : list of tuples
+        The (column, start, stop) of each gap that was too long to fill,
+        where y[start:stop, column] are the nans. Only returned if
+        full_output is True.
 
     Notes
     -----
@@ -334,20 +1659,83 @@ def spline_over_nan(x, y):
     replaced by new data from the spline fit.
 
     """
+    if method not in ['global', 'local']:
+        raise ValueError("{} is not a valid method, use 'global' or "
+                         "'local'.".format(method))
 
+    unfilled = []
+
+    nans = np.isnan(y)
     # if there are nans in the data then spline away
-    if np.isnan(y).any():
-        # remove the values with nans
-        xNoNan = x[np.nonzero(np.isnan(y) == False)]
-        yNoNan = y[np.nonzero(np.isnan(y) == False)]
-        # fit a spline through the data
-        spline = UnivariateSpline(xNoNan, yNoNan, k=3, s=0)
-        return spline(x)
+    if not nans.any():
+        ySpline = y
+    else:
+        ySpline = np.array(y, dtype=float)
+        columns = ySpline.reshape(len(x), -1)
+        nans = nans.reshape(columns.shape)
+
+        for column in range(columns.shape[1]):
+            if not nans[:, column].any():
+                continue
+            column_unfilled = _fill_nan_gaps(x, columns[:, column],
+                                             nans[:, column], method, margin,
+                                             max_gap)
+            unfilled += [(column, start, stop) for start, stop in
+                         column_unfilled]
+
+    if full_output is True:
+        return ySpline, unfilled
     else:
-        return y
+        return ySpline
+
 
+def _nan_runs(nans):
+    """Returns the start and stop indices of each run of True values in a
+    boolean vector."""
+    edges = np.diff(np.hstack(([0], nans.astype(int), [0])))
+    return np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
 
-def curve_area_stats(x, y):
+
+def _fill_nan_gaps(x, y, nans, method, margin, max_gap):
+    """Fills the nans in the vector y in place with splines, see
+    spline_over_nan, and returns the (start, stop) of the gaps that weren't
+    filled."""
+    starts, stops = _nan_runs(nans)
+
+    if max_gap is None:
+        too_long = np.zeros(len(starts), dtype=bool)
+    else:
+        too_long = stops - starts > max_gap
+    unfilled = [(start, stop) for start, stop, skip in
+                zip(starts, stops, too_long) if skip]
+
+    valid = np.nonzero(~nans)[0]
+
+    if method == 'global':
+        # remove the values with nans and fit a spline through the data
+        if len(valid) < 4:
+            return [(start, stop) for start, stop in zip(starts, stops)]
+        spline = UnivariateSpline(x[valid], y[valid], k=3, s=0)
+        for start, stop in zip(starts[~too_long], stops[~too_long]):
+            y[start:stop] = spline(x[start:stop])
+    else:
+        for start, stop in zip(starts[~too_long], stops[~too_long]):
+            # the nearest valid samples on either side of the gap
+            before = valid[:np.searchsorted(valid, start)][-margin:]
+            after = valid[np.searchsorted(valid, stop):][:margin]
+            near = np.hstack((before, after))
+            if len(near) < 2:
+                unfilled.append((start, stop))
+                continue
+            spline = UnivariateSpline(x[near], y[near],
+                                      k=min(3, len(near) - 1), s=0)
+            y[start:stop] = spline(x[start:stop])
+        unfilled.sort()
+
+    return unfilled
+
+
+def curve_area_stats(x, y, percentiles=None, interpolate=False):
     '''
     Return the box plot stats of a curve based on area.
 
@@ -359,10 +1747,19 @@ def curve_area_stats(x, y):
         The y values
         n are the time steps
         m are the various curves
+    percentiles : sequence of floats, optional, default=None
+        The percentages of the area, between 0 and 100, to find the x values
+        for. Defaults to the 2nd percentile, the quartiles and the 98th
+        percentile.
+    interpolate : boolean, optional, default=False
+        If true, the x values are linearly interpolated between the samples
+        on either side of each percentage of the area. Otherwise the first
+        sample where the cumulative area exceeds it is used.
 
     Returns
     -------
-    A dictionary containing:
+    A structured array, shape (m,), with a field for each percentile. The
+    default percentiles are named:
     median : ndarray, shape (m,)
         The x value corresponding to 0.5*area under the curve
     lq : ndarray, shape (m,)
@@ -373,43 +1770,64 @@ def curve_area_stats(x, y):
         98th percentile
     2p : ndarray, shape (m,)
         2nd percentile
+    and other percentiles are named 'p' followed by the percentage, e.g.
+    'p90' or 'p2.5'. The value is nan for curves whose cumulative area never
+    exceeds the percentage of the area.
 
     '''
-    area = trapz(y, x=x, axis=0) # shape (m,)
-    percents = np.array([0.02*area, 0.25*area, 0.5*area, 0.75*area, 0.98*area]) # shape (5,m)
-    CumArea = cumtrapz(y.T, x=x.T) # shape(m,n)
-    xstats = {'2p':[], 'lq':[], 'median':[], 'uq':[], '98p':[]}
-    for j, curve in enumerate(CumArea):
-        flags = [False for flag in range(5)]
-        for i, val in enumerate(curve):
-            if val > percents[0][j] and flags[0] == False:
-                xstats['2p'].append(x[i])
-                flags[0] = True
-            elif val > percents[1][j] and flags[1] == False:
-                xstats['lq'].append(x[i])
-                flags[1] = True
-            elif val > percents[2][j] and flags[2] == False:
-                xstats['median'].append(x[i])
-                flags[2] = True
-            elif val > percents[3][j] and flags[3] == False:
-                xstats['uq'].append(x[i])
-                flags[3] = True
-            elif val > percents[4][j] and flags[4] == False:
-                xstats['98p'].append(x[i])
-                flags[4] = True
-        if flags[4] == False:
-            # this is what happens if it finds none of the above
-            xstats['2p'].append(0.)
-            xstats['lq'].append(0.)
-            xstats['median'].append(0.)
-            xstats['uq'].append(0.)
-            xstats['98p'].append(0.)
-    for k, v in xstats.items():
-        xstats[k] = np.array(v)
+    names = {2.0: '2p', 25.0: 'lq', 50.0: 'median', 75.0: 'uq', 98.0: '98p'}
+    if percentiles is None:
+        percentiles = [2.0, 25.0, 50.0, 75.0, 98.0]
+    percentiles = np.asarray(percentiles, dtype=float)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 1:
+        y = y[:, np.newaxis]
+    n, m = y.shape
+
+    # cumulative area at each x value, shape (m,n)
+    cum_area = np.hstack((np.zeros((m, 1)), cumtrapz(y.T, x=x)))
+    area = cum_area[:, -1]
+
+    # The first x value where the cumulative area exceeds a fraction of the
+    # area is also the first where its running maximum does, which is
+    # sorted, so all of the curves can be searched at once by offsetting
+    # each curve's fractions by a multiple of a number larger than them.
+    valid = area > 0.0
+    safe_area = np.where(valid, area, 1.0)[:, np.newaxis]
+    fraction = np.maximum.accumulate(cum_area, axis=1) / safe_area
+    fraction[~valid] = 0.0
+    span = fraction.max() + 1.0
+    offsets = span * np.arange(m)[:, np.newaxis]
+    targets = percentiles / 100.0 + offsets
+    index = np.searchsorted((fraction + offsets).ravel(), targets.ravel(),
+                            side='right').reshape(m, len(percentiles))
+    index -= n * np.arange(m)[:, np.newaxis]
+
+    found = (index < n) & valid[:, np.newaxis]
+    index = np.clip(index, 1, n - 1)
+    rows = np.arange(m)[:, np.newaxis]
+
+    if interpolate:
+        before = fraction[rows, index - 1]
+        after = fraction[rows, index]
+        step = np.where(after > before, after - before, 1.0)
+        weight = np.clip((percentiles / 100.0 - before) / step, 0.0, 1.0)
+        values = x[index - 1] + weight * (x[index] - x[index - 1])
+    else:
+        values = x[index]
+    values = np.where(found, values, np.nan)
+
+    fields = [names.get(q, 'p{:g}'.format(q)) for q in percentiles]
+    xstats = np.zeros(m, dtype=[(field, float) for field in fields])
+    for field, column in zip(fields, values.T):
+        xstats[field] = column
     return xstats
 
 
-def freq_spectrum(data, sampleRate):
+def freq_spectrum(data, sampleRate, axis=-1, method='fft', nperseg=256,
+                  noverlap=None, window='hann'):
     """
     Return the frequency spectrum of a data set.
 
@@ -417,57 +1835,350 @@ def freq_spectrum(data, sampleRate):
     ----------
     data : ndarray, shape (m,) or shape(n,m)
         The array of time signals where n is the number of variables and m is
-        the number of time steps.
+        the number of time steps. Arrays of any dimension are accepted, see
+        axis. float32 data is transformed in single precision.
     sampleRate : int
         The signal sampling rate in hertz.
+    axis : int, optional, default=-1
+        The time axis of data.
+    method : {'fft'|'welch'}, optional, default='fft'
+        'fft' transforms the whole signal zero padded to the next power of
+        2. 'welch' averages the power of windowed, overlapping segments,
+        which reduces the variance of the spectrum at the cost of frequency
+        resolution.
+    nperseg : int, optional, default=256
+        The number of samples in each segment for the 'welch' method.
+    noverlap : int, optional, default=None
+        The number of samples the segments overlap for the 'welch' method.
+        Defaults to nperseg // 2.
+    window : string or tuple or array_like, optional, default='hann'
+        The window applied to each segment for the 'welch' method, see
+        scipy.signal.get_window.
 
     Returns
     -------
     frequency : ndarray, shape (p,)
-        The frequencies where p is a power of 2 close to m.
+        The frequencies where p is a power of 2 close to m, or nperseg / 2
+        for the 'welch' method.
     amplitude : ndarray, shape (p,n)
-        The amplitude at each frequency.
+        The amplitude at each frequency. In general, the frequency is along
+        the first axis followed by the remaining axes of data.
 
     """
-    def nextpow2(i):
-        '''
-        Return the next power of 2 for the given number.
-
-        '''
-        n = 2
-        while n < i: n *= 2
-        return n
-
-    time = 1. / sampleRate # sample time
-    try:
-        L = data.shape[1] # length of data if (n, m)
-    except:
-        L = data.shape[0] # length of data if (n,)
-    # calculate the closest power of 2 for the length of the data
-    n = nextpow2(L)
-    Y = fft(data, n) / L # divide by L for scaling
-    f = fftfreq(n, d=time)
-    #f = sampleRate/2.*linspace(0, 1, n)
-    #print 'f =', f, f.shape, type(f)
-    frequency = f[1:n / 2]
-    try:
-        amplitude = 2 * abs(Y[:, 1:n / 2]).T # multiply by 2 because we take half the vector
-        #power = abs(Y[:, 1:n/2])**2
-    except:
-        amplitude = 2 * abs(Y[1:n / 2])
-        #power = abs(Y[1:n/2])**2
-    return frequency, amplitude
+    data = np.asarray(data)
+    if data.dtype != np.float32:
+        data = data.astype(float)
+
+    # the time axis is last from here on
+    data = np.rollaxis(data, axis % data.ndim, data.ndim)
+    L = data.shape[-1]
+
+    if method == 'fft':
+        # calculate the closest power of 2 for the length of the data
+        n = 2 ** max(int(np.ceil(np.log2(L))), 1)
+        # divide by L for scaling and multiply by 2 because we take half the
+        # vector
+        amplitude = 2.0 / L * _rfft_magnitude(data, n)[..., 1:n // 2]
+    elif method == 'welch':
+        n = min(int(nperseg), L)
+        if noverlap is None:
+            noverlap = n // 2
+        step = n - int(noverlap)
+        if step <= 0:
+            raise ValueError('noverlap must be less than nperseg.')
+
+        taper = get_window(window, n).astype(data.dtype)
+        # the window reduces the amplitude by its mean value
+        scale = 2.0 / taper.sum()
+
+        power = np.zeros(data.shape[:-1] + (n // 2 - 1,), dtype=data.dtype)
+        starts = range(0, L - n + 1, step)
+        for start in starts:
+            segment = data[..., start:start + n]
+            segment = (segment - segment.mean(axis=-1)[..., np.newaxis]) * \
+                taper
+            power += _rfft_magnitude(segment, n)[..., 1:n // 2] ** 2
+        amplitude = scale * np.sqrt(power / len(starts))
+    else:
+        raise ValueError("{} is not a valid method, use 'fft' or "
+                         "'welch'.".format(method))
+
+    frequency = np.arange(1, n // 2) * float(sampleRate) / n
+
+    return frequency, np.rollaxis(amplitude, amplitude.ndim - 1, 0)
+
+
+class StreamingSTFT(object):
+    """Computes the short time Fourier transform of a signal that arrives in
+    chunks, i.e. a spectrogram, without holding the whole signal in
+    memory."""
+
+    def __init__(self, sampleRate, nperseg=256, noverlap=None,
+                 window='hann', dtype=np.float64):
+        """Returns a StreamingSTFT object.
+
+        Parameters
+        ----------
+        sampleRate : float
+            The signal sampling rate in hertz.
+        nperseg : int, optional, default=256
+            The number of samples in each frame.
+        noverlap : int, optional, default=None
+            The number of samples consecutive frames overlap. Defaults to
+            nperseg // 2, the hop between frames is nperseg - noverlap.
+        window : string or tuple or array_like, optional, default='hann'
+            The window applied to each frame, see scipy.signal.get_window.
+        dtype : numpy.dtype, optional, default=numpy.float64
+            The data type of the frames, numpy.float32 transforms in single
+            precision.
+
+        """
+        self.sample_rate = float(sampleRate)
+        self.nperseg = int(nperseg)
+        if noverlap is None:
+            noverlap = self.nperseg // 2
+        self.hop = self.nperseg - int(noverlap)
+        if self.hop <= 0:
+            raise ValueError('noverlap must be less than nperseg.')
+        self.dtype = np.dtype(dtype)
+
+        self.window = get_window(window, self.nperseg).astype(self.dtype)
+        # the same scaling as freq_spectrum
+        self._scale = 2.0 / self.window.sum()
+
+        self.frequency = (np.arange(1, self.nperseg // 2) * self.sample_rate /
+                          self.nperseg)
+
+        self._buffer = None
+        self._workspace = None
+        # index of the first buffered sample in the full signal
+        self._start = 0
+
+    def num_frames(self, num_samples):
+        """Returns the number of frames in a signal with num_samples
+        samples, e.g. to allocate an output array for frames."""
+        if num_samples < self.nperseg:
+            return 0
+        return (num_samples - self.nperseg) // self.hop + 1
+
+    def update(self, chunk):
+        """Adds the next chunk of the signal and returns an iterator over
+        the frames that are complete.
+
+        Parameters
+        ----------
+        chunk : array_like, shape(..., m)
+            The next samples of the signal, with time along the last axis.
+
+        Returns
+        -------
+        frames : iterator
+            Yields the time at the center of each frame and the amplitude,
+            shape(p, ...), at each frequency in the frame, a new array for
+            each frame. The chunk is added when update is called, and a frame
+            is only removed once it is yielded, so frames that aren't
+            consumed are yielded by the next iterator instead.
+
+        """
+        chunk = np.asarray(chunk, dtype=self.dtype)
+        if self._buffer is None:
+            # copy, as the caller may reuse the chunk's memory
+            self._buffer = chunk.copy()
+            self._workspace = np.empty(self._buffer.shape[:-1] +
+                                       (self.nperseg,), self.dtype)
+        else:
+            self._buffer = np.concatenate((self._buffer, chunk), axis=-1)
+
+        return self._complete_frames()
+
+    def _complete_frames(self):
+        """Yields the frames in the buffer, dropping each one's leading
+        samples as it is yielded."""
+        while self.nperseg <= self._buffer.shape[-1]:
+            frame = self._buffer[..., :self.nperseg]
+            np.subtract(frame, frame.mean(axis=-1)[..., np.newaxis],
+                        out=self._workspace)
+            np.multiply(self._workspace, self.window, out=self._workspace)
+            amplitude = _rfft_magnitude(self._workspace, self.nperseg)
+            amplitude = amplitude[..., 1:self.nperseg // 2]
+            amplitude *= self._scale
+
+            time = (self._start + 0.5 * (self.nperseg - 1)) / \
+                self.sample_rate
+
+            # only keep the samples that later frames need
+            self._buffer = self._buffer[..., self.hop:]
+            self._start += self.hop
+
+            yield time, np.rollaxis(amplitude, amplitude.ndim - 1, 0)
+
+    def frames(self, chunks, out=None):
+        """Yields the frames of a signal given as an iterable of chunks.
+
+        Parameters
+        ----------
+        chunks : iterable of array_like, shape(..., m)
+            The chunks of the signal, with time along the last axis.
+        out : array_like, shape(q, p, ...), optional, default=None
+            An array, e.g. a numpy.memmap, that each frame is written to in
+            turn. Use num_frames to find q.
+
+        Yields
+        ------
+        time : float
+            The time at the center of the frame.
+        amplitude : ndarray, shape(p, ...)
+            The amplitude at each frequency in the frame. This is a view of
+            out if it is given.
+
+        """
+        i = 0
+        for chunk in chunks:
+            for time, amplitude in self.update(chunk):
+                if out is not None:
+                    out[i] = amplitude
+                    amplitude = out[i]
+                i += 1
+                yield time, amplitude
+
+
+class RunningPSD(object):
+    """Accumulates a Welch estimate of the power spectral density of a signal
+    that arrives in chunks."""
+
+    def __init__(self, sampleRate, nperseg=256, noverlap=None,
+                 window='hann'):
+        """Returns a RunningPSD object.
+
+        Parameters
+        ----------
+        sampleRate : float
+            The signal sampling rate in hertz.
+        nperseg : int, optional, default=256
+            The number of samples in each segment.
+        noverlap : int, optional, default=None
+            The number of samples consecutive segments overlap. Defaults to
+            nperseg // 2.
+        window : string or tuple or array_like, optional, default='hann'
+            The window applied to each segment, see scipy.signal.get_window.
+
+        """
+        self._stft = StreamingSTFT(sampleRate, nperseg=nperseg,
+                                   noverlap=noverlap, window=window)
+        self.frequency = self._stft.frequency
+
+        # converts the squared amplitude of a StreamingSTFT frame to a one
+        # sided power spectral density
+        window = self._stft.window
+        self._scale = window.sum() ** 2 / (2.0 * self._stft.sample_rate *
+                                           np.sum(window ** 2))
+
+        self.count = 0
+        self._power = None
+
+    def update(self, chunk):
+        """Adds the next chunk of the signal to the estimate.
+
+        Parameters
+        ----------
+        chunk : array_like, shape(..., m)
+            The next samples of the signal, with time along the last axis.
+
+        Returns
+        -------
+        self : RunningPSD
+            This object.
+
+        """
+        for time, amplitude in self._stft.update(chunk):
+            if self._power is None:
+                self._power = amplitude ** 2
+            else:
+                self._power += amplitude ** 2
+            self.count += 1
+        return self
+
+    def merge(self, other):
+        """Adds the segments accumulated by another RunningPSD, e.g. one
+        computed on a different part of the signal by another worker, to
+        this one. Samples that the other object holds for an incomplete
+        segment are not included.
+
+        Parameters
+        ----------
+        other : RunningPSD
+            An object with the same sample rate, segment length and window.
+
+        Returns
+        -------
+        self : RunningPSD
+            This object.
+
+        """
+        if (other._stft.sample_rate != self._stft.sample_rate or
+                other._stft.nperseg != self._stft.nperseg or
+                not np.array_equal(other._stft.window, self._stft.window)):
+            raise ValueError('Only estimates with the same sample rate, '
+                             'segment length and window can be merged.')
+
+        if other._power is not None:
+            if self._power is None:
+                self._power = other._power.copy()
+            else:
+                self._power += other._power
+            self.count += other.count
+
+        return self
+
+    def psd(self):
+        """Returns the current estimate of the power spectral density.
+
+        Returns
+        -------
+        frequency : ndarray, shape(p,)
+            The frequencies, the same as freq_spectrum's with the 'welch'
+            method.
+        psd : ndarray, shape(p, ...)
+            The power spectral density at each frequency, in units squared
+            per hertz.
+
+        """
+        if self.count == 0:
+            raise ValueError('No complete segments have been accumulated.')
+        return self.frequency, self._scale * self._power / self.count
+
+
+def _rfft_magnitude(data, n):
+    """Returns the magnitude of the discrete Fourier transform of real data
+    along the last axis for the frequencies 0 to n // 2. float32 data is
+    transformed in single precision."""
+    if data.dtype == np.float32:
+        # scipy.fftpack keeps single precision, its real transform is packed
+        # as [y(0), Re(y(1)), Im(y(1)), ..., Re(y(n/2))]
+        packed = fftpack.rfft(data, n, axis=-1)
+        magnitude = np.empty(data.shape[:-1] + (n // 2 + 1,), np.float32)
+        magnitude[..., 0] = np.abs(packed[..., 0])
+        real = packed[..., 1:n - 1:2] if n % 2 == 0 else packed[..., 1::2]
+        imag = packed[..., 2::2]
+        magnitude[..., 1:imag.shape[-1] + 1] = np.hypot(real, imag)
+        if n % 2 == 0:
+            magnitude[..., -1] = np.abs(packed[..., -1])
+        return magnitude
+    else:
+        return np.abs(np.fft.rfft(data, n, axis=-1))
 
 
 def butterworth(data, cutoff, samplerate, order=2, axis=-1, btype='lowpass',
+                out=None, chunk_size=None, output='sos', threads=1,
                 **kwargs):
     """Returns the data filtered by a forward/backward pass Butterworth
     filter.
 
     Parameters
     ----------
-    data : ndarray, shape(n,) or shape(n,m)
-        The data to filter. Only handles 1D and 2D arrays.
+    data : ndarray, shape(..., n, ...)
+        The data to filter. Only 1D and 2D arrays are supported with SciPy
+        0.9.0.
     cutoff : float
         The filter cutoff frequency in hertz.
     samplerate : float
@@ -478,34 +2189,118 @@ def butterworth(data, cutoff, samplerate, order=2, axis=-1, btype='lowpass',
         The axis to filter along.
     btype : {'lowpass'|'highpass'|'bandpass'|'bandstop'}
         The type of filter. Default is 'lowpass'.
+    out : array_like, optional, default=None
+        An array with the same shape as data, e.g. a numpy.memmap, that the
+        filtered data is written to. If given, or if chunk_size is given,
+        the data is filtered chunk by chunk, so that data and out can be
+        larger than the available memory.
+    chunk_size : integer, optional, default=None
+        The number of samples along axis that are read from data at a time
+        when filtering chunk by chunk. Defaults to 65536 if out is given.
+    output : {'sos'|'ba'}, optional, default='sos'
+        The form of the filter, either second-order sections, which are
+        numerically stable at high orders and low cutoff frequencies, or
+        numerator and denominator coefficients. 'sos' requires SciPy 0.16.0
+        or newer and 'ba' is used with older versions, or if kwargs has
+        arguments that the second-order sections filter doesn't support.
+    threads : integer, optional, default=1
+        The number of threads that the channels, i.e. the slices of data
+        along axis, are split across. The SciPy filter routines release the
+        GIL, so this speeds up filtering of many channels. It is ignored
+        when filtering chunk by chunk.
     kwargs : keyword value pairs
-        Any extra arguments to get passed to scipy.signal.filtfilt.
+        Any extra arguments to get passed to scipy.signal.filtfilt (or
+        scipy.signal.sosfiltfilt). Only padlen is supported when filtering
+        chunk by chunk.
 
     Returns
     -------
     filtered_data : ndarray
-        The low pass filtered version of data.
+        The low pass filtered version of data. This is out if it is given.
 
     """
-    if len(data.shape) > 2:
-        raise ValueError('This function only works with 1D or 2D arrays.')
-
     nyquist_frequency = 0.5 * samplerate
 
     # Wn is the ratio of the cutoff frequency to the Nyquist frequency.
     Wn = cutoff / nyquist_frequency
 
-    b, a = butter(order, Wn, btype=btype)
+    if output == 'sos' and not _SCIPY_HAS_SOS:
+        output = 'ba'
+
+    # sosfiltfilt doesn't have filtfilt's method and irlen arguments and
+    # before SciPy 0.18.0 the sections are filtered by _chunked_filtfilt
+    if _SCIPY_HAS_SOSFILTFILT:
+        sos_kwargs = set(['padlen', 'padtype'])
+    else:
+        sos_kwargs = set(['padlen'])
+    if output == 'sos' and set(kwargs.keys()) - sos_kwargs:
+        output = 'ba'
+
+    coefficients = _butter_coefficients(order, Wn, btype, output)
+
+    if out is not None or chunk_size is not None:
+        if set(kwargs.keys()) - set(['padlen']):
+            raise ValueError('Only padlen is supported when filtering '
+                             'chunk by chunk.')
+        if out is None:
+            out = np.empty(data.shape)
+        if chunk_size is None:
+            chunk_size = 2 ** 16
+        return _chunked_filtfilt(coefficients, data, out, axis, chunk_size,
+                                 kwargs.get('padlen'))
+
+    num_channels = data.size // max(data.shape[axis], 1)
+
+    if threads > 1 and num_channels > 1:
+        # put the filtered axis last and stack the channels in rows, so
+        # that blocks of rows can be filtered independently
+        samples = np.rollaxis(np.asarray(data), axis, len(data.shape))
+        rows = samples.reshape(num_channels, samples.shape[-1])
+        filtered = np.empty(rows.shape)
+
+        def filter_block(block):
+            filtered[block] = _filtfilt(coefficients, rows[block], -1,
+                                        **kwargs)
+
+        bounds = np.linspace(0, num_channels, min(threads, num_channels) +
+                             1).astype(int)
+        blocks = [slice(start, stop) for start, stop in zip(bounds[:-1],
+                                                            bounds[1:])]
+        pool = ThreadPool(len(blocks))
+        try:
+            pool.map(filter_block, blocks)
+        finally:
+            pool.close()
+            pool.join()
+
+        filtered = filtered.reshape(samples.shape)
+        return np.rollaxis(filtered, len(data.shape) - 1, axis %
+                           len(data.shape))
+    else:
+        return _filtfilt(coefficients, data, axis, **kwargs)
+
+
+def _filtfilt(coefficients, data, axis, **kwargs):
+    """Returns the data filtered forward and backward in memory with either
+    second-order sections or the (b, a) coefficients, see butterworth."""
+
+    if not isinstance(coefficients, tuple):
+        if _SCIPY_HAS_SOSFILTFILT:
+            return sosfiltfilt(coefficients, data, axis=axis, **kwargs)
+        else:
+            return _chunked_filtfilt(coefficients, data,
+                                     np.empty(data.shape), axis,
+                                     data.shape[axis], kwargs.get('padlen'))
+
+    b, a = coefficients
 
     # SciPy 0.9.0 has a simple filtfilt, with no optional arguments. SciPy
     # 0.10.0 introduced the axis argument. So, to stay compatible with
     # 0.9.0, which is the SciPy installed on Ubuntu 12.04 LTS, we check the
     # version. The version in SciPy 0.9.0 doesn't have kwargs either.
-    nine = LooseVersion('0.9.0')
-    ten = LooseVersion('0.10.0')
-    current = LooseVersion(scipy_version)
-
-    if current >= nine and current < ten:
+    if not _SCIPY_HAS_FILTFILT_AXIS:
+        if len(data.shape) > 2:
+            raise ValueError('SciPy 0.9.0 only supports 1D or 2D arrays.')
         print('SciPy 0.9.0 only supports 1D filtfilt, ' +
               'so you get a slow version.')
         if len(data.shape) == 2:
@@ -520,65 +2315,450 @@ def butterworth(data, cutoff, samplerate, order=2, axis=-1, btype='lowpass',
                 return filtered
         else:
             return filtfilt(b, a, data)
-    elif current >= ten:
+    else:
         return filtfilt(b, a, data, axis=axis, **kwargs)
 
 
-def subtract_mean(sig, hasNans=False):
+def _butter_coefficients(order, Wn, btype, output):
+    """Returns the Butterworth filter designed by scipy.signal.butter. The
+    designs are cached, as butterworth is often called many times with the
+    same filter.
+
+    Parameters
+    ----------
+    order : int
+        The order of the filter.
+    Wn : float or sequence of floats
+        The critical frequencies normalized by the Nyquist frequency.
+    btype : string
+        The type of filter.
+    output : {'sos'|'ba'}
+        The form of the filter.
+
+    Returns
+    -------
+    coefficients : ndarray or tuple of ndarrays
+        The second-order sections, shape(n_sections, 6), if output is 'sos'
+        or the numerator and denominator coefficients, (b, a), if output is
+        'ba'. The arrays are read only, as they are shared between calls.
+
+    """
+    key = (int(order), tuple(np.atleast_1d(Wn).astype(float)), btype, output)
+
+    try:
+        coefficients = _BUTTER_CACHE.pop(key)
+    except KeyError:
+        if output == 'sos':
+            coefficients = butter(order, Wn, btype=btype, output='sos')
+            coefficients.flags.writeable = False
+        else:
+            coefficients = butter(order, Wn, btype=btype)
+            for array in coefficients:
+                array.flags.writeable = False
+        if len(_BUTTER_CACHE) >= _BUTTER_CACHE_SIZE:
+            # remove the least recently used design
+            _BUTTER_CACHE.popitem(last=False)
+
+    _BUTTER_CACHE[key] = coefficients
+
+    return coefficients
+
+
+def _chunked_filtfilt(coefficients, data, out, axis, chunk_size,
+                      padlen=None):
+    """Applies a linear filter forward and backward to data, reading it and
+    writing the result to out chunk by chunk. The result is the same as
+    scipy.signal.filtfilt (or sosfiltfilt) with an odd extension of padlen
+    samples.
+
+    The filter is either second-order sections, an ndarray shape(n, 6), or
+    a tuple of the numerator and denominator coefficients, (b, a).
+
+    The forward pass carries the filter state from chunk to chunk and
+    stores its result in out, then the backward pass runs over out in
+    reverse, so only a chunk and the end extensions are in memory at any
+    time.
+
+    """
+    axis = axis % len(data.shape)
+    n = data.shape[axis]
+
+    if isinstance(coefficients, tuple):
+        b, a = coefficients
+        ntaps = max(len(a), len(b))
+        default_padlen = 3 * ntaps
+        # the steady state of the filter for a unit step input
+        zi_shape = [1] * len(data.shape)
+        zi_shape[axis] = ntaps - 1
+        zi = lfilter_zi(b, a).reshape(zi_shape)
+
+        def filt(x, z):
+            return lfilter(b, a, x, axis=axis, zi=z)
+    else:
+        sos = coefficients
+        # the same default as scipy.signal.sosfiltfilt
+        default_padlen = 3 * (2 * len(sos) + 1 -
+                              min((sos[:, 2] == 0).sum(),
+                                  (sos[:, 5] == 0).sum()))
+        # the steady state of each section for a unit step input
+        zi_shape = [len(sos)] + [1] * len(data.shape)
+        zi_shape[axis + 1] = 2
+        zi = sosfilt_zi(sos).reshape(zi_shape)
+
+        def filt(x, z):
+            return sosfilt(sos, x, axis=axis, zi=z)
+
+    if padlen is None:
+        padlen = default_padlen
+    if n <= padlen:
+        raise ValueError('The length of the data along axis must be greater '
+                         'than padlen, {}.'.format(padlen))
+    if out.shape != data.shape:
+        raise ValueError('out must have the same shape as data.')
+
+    def index(start, stop, step=1):
+        idx = [slice(None)] * len(data.shape)
+        idx[axis] = slice(start, stop, step)
+        return tuple(idx)
+
+    def read(start, stop, step=1):
+        return np.asarray(data[index(start, stop, step)], dtype=float)
+
+    if padlen > 0:
+        # odd extensions of the ends, as in scipy.signal.filtfilt
+        first, last = read(0, 1), read(n - 1, n)
+        front = 2.0 * first - read(padlen, 0, -1)
+        back = 2.0 * last - read(n - 2, n - padlen - 2 if n > padlen + 1
+                                 else None, -1)
+        # the initial state is scaled by the first sample
+        y, z = filt(front, zi * front[index(0, 1)])
+    else:
+        z = zi * read(0, 1)
+
+    # forward pass
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        out[index(start, stop)], z = filt(read(start, stop), z)
+
+    # backward pass, the front extension isn't needed in the result
+    if padlen > 0:
+        y, z = filt(back, z)
+        y = y[index(None, None, -1)]
+        y, z = filt(y, zi * y[index(0, 1)])
+    else:
+        z = zi * np.asarray(out[index(n - 1, n)], dtype=float)
+    for stop in range(n, 0, -chunk_size):
+        start = max(stop - chunk_size, 0)
+        reverse = np.asarray(out[index(stop - 1, start - 1 if start > 0
+                                       else None, -1)], dtype=float)
+        y, z = filt(reverse, z)
+        out[index(start, stop)] = y[index(None, None, -1)]
+
+    return out
+
+
+def resample(data, sample_rate, new_rate, axis=-1, max_denominator=1000,
+             block_size=2 ** 20):
+    """Returns the data resampled to a new sample rate with a rational
+    polyphase filter.
+
+    Parameters
+    ----------
+    data : array_like
+        The signal(s).
+    sample_rate : float
+        The sample rate of the data in hertz.
+    new_rate : float
+        The desired sample rate in hertz.
+    axis : int, optional, default=-1
+        The axis along which the data is sampled.
+    max_denominator : int, optional, default=1000
+        The largest up or down sampling factor. The ratio of the rates is
+        approximated by the closest fraction with a denominator up to this.
+    block_size : int, optional, default=2**20
+        The maximum number of output samples times filter taps computed at
+        once.
+
+    Returns
+    -------
+    resampled : ndarray
+        The resampled data. The first sample is at the time of the first
+        input sample and there are ceil(n * up / down) samples along axis.
+
+    Notes
+    -----
+    The data is conceptually upsampled by inserting up - 1 zeros between
+    samples, low pass filtered below the lower of the two Nyquist frequencies
+    with a Kaiser windowed FIR filter and downsampled by keeping every down
+    th sample. Only the filter taps that multiply nonzero samples and only
+    the kept outputs are computed, i.e. a polyphase implementation, and the
+    filter delay is removed. The data is treated as zero beyond its ends, so
+    the first and last few samples are attenuated.
+
+    """
+    data = np.asarray(data)
+    up, down = _rate_ratio(sample_rate, new_rate, max_denominator)
+
+    if up == down == 1:
+        return data.copy()
+
+    phases, delay = _resample_filter(up, down)
+    taps = phases.shape[1]
+
+    moved = np.rollaxis(data, axis, data.ndim)
+    num_samples = moved.shape[-1]
+    num_out = -(-num_samples * up // down)
+
+    # pad with zeros so every output sample can gather a full set of taps
+    padded = np.zeros(moved.shape[:-1] + (num_samples + 2 * taps,),
+                      dtype=np.result_type(moved.dtype, np.float64))
+    padded[..., taps:taps + num_samples] = moved
+
+    resampled = np.empty(moved.shape[:-1] + (num_out,), dtype=padded.dtype)
+    step = max(1, block_size // taps)
+    for start in range(0, num_out, step):
+        # the outputs in the upsampled signal, their phases and the inputs
+        # they depend on
+        upsampled = np.arange(start, min(start + step, num_out)) * down + \
+            delay
+        phase = upsampled % up
+        index = (upsampled // up)[:, np.newaxis] - np.arange(taps) + taps
+        resampled[..., start:start + step] = np.sum(
+            padded[..., index] * phases[phase], axis=-1)
+
+    return np.rollaxis(resampled, -1, axis % data.ndim)
+
+
+def _rate_ratio(sample_rate, new_rate, max_denominator):
+    """Returns the up and down sampling factors for a change in rate."""
+    if sample_rate <= 0 or new_rate <= 0:
+        raise ValueError('The sample rates must be positive.')
+    ratio = (Fraction(new_rate) / Fraction(sample_rate)).limit_denominator(
+        max_denominator)
+    if ratio.numerator > max_denominator:
+        raise ValueError('The ratio of the sample rates, {}, needs more than '
+                         '{} times upsampling.'.format(ratio,
+                                                       max_denominator))
+    return ratio.numerator, ratio.denominator
+
+
+def _resample_filter(up, down):
+    """Returns the polyphase decomposition of the anti-aliasing filter for
+    resampling by up / down. The designs are cached, as the same ratios are
+    used many times.
+
+    Parameters
+    ----------
+    up : int
+        The upsampling factor.
+    down : int
+        The downsampling factor.
+
+    Returns
+    -------
+    phases : ndarray, shape(up, taps)
+        The filter coefficients of each phase, phases[p, j] = h[p + j * up].
+        The array is read only, as it is shared between calls.
+    delay : int
+        The delay of the filter in upsampled samples.
+
+    """
+    key = (int(up), int(down))
+
+    try:
+        phases, delay = _RESAMPLE_CACHE.pop(key)
+    except KeyError:
+        max_rate = max(up, down)
+        # ten zero crossings of the sinc function on each side, as
+        # scipy.signal.resample_poly does
+        delay = 10 * max_rate
+        h = up * firwin(2 * delay + 1, 1.0 / max_rate, window=('kaiser', 5.0))
+        taps = -(-len(h) // up)
+        phases = np.zeros(taps * up)
+        phases[:len(h)] = h
+        phases = phases.reshape(taps, up).T.copy()
+        phases.flags.writeable = False
+        if len(_RESAMPLE_CACHE) >= _RESAMPLE_CACHE_SIZE:
+            # remove the least recently used design
+            _RESAMPLE_CACHE.popitem(last=False)
+
+    _RESAMPLE_CACHE[key] = phases, delay
+
+    return phases, delay
+
+
+def resample_channels(channels, sample_rates, new_rate=None,
+                      start_times=None, max_denominator=1000):
+    """Returns channels recorded at different sample rates resampled onto a
+    common time base.
+
+    Parameters
+    ----------
+    channels : sequence of array_like, each shape(n_i,)
+        The signals.
+    sample_rates : sequence of floats
+        The sample rate of each signal in hertz.
+    new_rate : float, optional, default=None
+        The common sample rate. Defaults to the highest of the sample rates.
+    start_times : sequence of floats, optional, default=None
+        The time of the first sample of each signal. Defaults to zero for
+        all of them.
+    max_denominator : int, optional, default=1000
+        The largest up or down sampling factor, see resample.
+
+    Returns
+    -------
+    time : TimeBase
+        The common time base, spanning the times where all of the channels
+        have samples.
+    resampled : ndarray, shape(len(channels), m)
+        The resampled signals, one per row, e.g. to pass pairs of rows and
+        time.rate to find_timeshift or truncate_data, or pairs of rows and
+        time to sync_error.
+
+    Notes
+    -----
+    Each channel is resampled with resample. If a channel's start time is
+    not on the common time base, its resampled values are linearly
+    interpolated at the common times, which at the higher rate is a much
+    smaller error than interpolating the original signal.
+
+    """
+    if len(channels) != len(sample_rates):
+        raise ValueError('There must be one sample rate per channel.')
+    if start_times is None:
+        start_times = [0.0] * len(channels)
+    elif len(start_times) != len(channels):
+        raise ValueError('There must be one start time per channel.')
+    if new_rate is None:
+        new_rate = max(sample_rates)
+
+    times = []
+    signals = []
+    for channel, rate, start in zip(channels, sample_rates, start_times):
+        up, down = _rate_ratio(rate, new_rate, max_denominator)
+        signal = resample(channel, rate, new_rate,
+                          max_denominator=max_denominator)
+        # the actual rate after approximating the ratio
+        times.append(TimeBase(start, float(rate) * up / down, len(signal)))
+        signals.append(signal)
+
+    first = max(time.start for time in times)
+    last = min(time.stop for time in times)
+    if last < first:
+        raise ValueError('The channels do not overlap in time.')
+    # the small tolerance keeps a last sample that is only lost to round off
+    length = int(np.floor((last - first) * new_rate + 1e-9)) + 1
+    time = TimeBase(first, new_rate, length)
+
+    aligned = np.empty((len(channels), length))
+    for i, (channel_time, signal) in enumerate(zip(times, signals)):
+        offset = (first - channel_time.start) * channel_time.rate
+        if channel_time.rate == time.rate and np.isclose(offset,
+                                                         round(offset)):
+            # the channel is already sampled at the common times
+            start = int(round(offset))
+            aligned[i] = signal[start:start + length]
+        else:
+            aligned[i] = channel_time.interp(time.values(), signal)
+
+    return time, aligned
+
+
+def subtract_mean(sig, hasNans=False, axis=None, out=None):
     '''
     Subtracts the mean from a signal with nanmean.
 
     Parameters
     ----------
-    sig : ndarray, shape(n,)
+    sig : ndarray, shape(n,) or shape(..., n, ...)
     hasNans : boolean, optional
-        If your data has nans use this flag if you want to ignore them.
+        If your data has nans use this flag if you want to ignore them. The
+        nans are ignored in any case, as they are detected while the mean is
+        computed, this just skips that first attempt.
+    axis : int, optional, default=None
+        The axis to take the mean along, e.g. -1 for a (channels x samples)
+        array. By default the mean of the whole array is used.
+    out : ndarray, optional, default=None
+        The array to store the result in, use sig to subtract the mean in
+        place.
 
     Returns
     -------
-    ndarray, shape(n,)
-        sig minus the mean of sig
+    ndarray, shape(n,) or shape(..., n, ...)
+        sig minus the mean of sig, with the same dtype as sig if it is a
+        floating point array.
 
     '''
-    if hasNans:
-        return sig - nanmean(sig)
-    else:
-        return sig - np.mean(sig)
+    sig = np.asarray(sig)
+
+    # the mean is nan if and only if there are nans, so they are only
+    # looked for again if needed
+    mean = None if hasNans else np.mean(sig, axis=axis)
+    if mean is None or np.isnan(mean).any():
+        mean = nanmean(sig, axis=axis)
+
+    return _apply_statistic(np.subtract, sig, mean, axis, out)
 
 
-def normalize(sig, hasNans=False):
+def normalize(sig, hasNans=False, axis=None, out=None):
     '''
     Normalizes the vector with respect to the maximum value.
 
     Parameters
     ----------
-    sig : ndarray, shape(n,)
+    sig : ndarray, shape(n,) or shape(..., n, ...)
     hasNans : boolean, optional
-        If your data has nans use this flag if you want to ignore them.
+        If your data has nans use this flag if you want to ignore them. The
+        nans are ignored in any case, as they are detected while the maximum
+        is computed, this just skips that first attempt.
+    axis : int, optional, default=None
+        The axis to take the maximum along, e.g. -1 for a (channels x
+        samples) array. By default the maximum of the whole array is used.
+    out : ndarray, optional, default=None
+        The array to store the result in, use sig to normalize in place.
 
     Returns
     -------
-    normSig : ndarray, shape(n,)
-        The signal normalized with respect to the maximum value.
+    normSig : ndarray, shape(n,) or shape(..., n, ...)
+        The signal normalized with respect to the maximum value, with the
+        same dtype as sig if it is a floating point array.
 
     '''
-    # TODO : This could be a try/except statement instead of an optional
-    # argument.
-    if hasNans:
-        normSig = sig / np.nanmax(sig)
-    else:
-        normSig = sig / np.max(sig)
+    sig = np.asarray(sig)
+
+    # the maximum is nan if and only if there are nans, so they are only
+    # looked for again if needed
+    maximum = None if hasNans else np.max(sig, axis=axis)
+    if maximum is None or np.isnan(maximum).any():
+        maximum = np.nanmax(sig, axis=axis)
+
+    return _apply_statistic(np.divide, sig, maximum, axis, out)
 
-    return normSig
+
+def _apply_statistic(operation, sig, statistic, axis, out):
+    '''Returns operation(sig, statistic), where the statistic was reduced
+    along axis, keeping floating point dtypes and writing to out.'''
+    if np.issubdtype(sig.dtype, np.floating):
+        dtype = sig.dtype
+    else:
+        dtype = np.float64
+    statistic = np.asarray(statistic, dtype=dtype)
+    if axis is not None:
+        statistic = np.expand_dims(statistic, axis)
+    if out is None:
+        out = np.empty(sig.shape, dtype=dtype)
+    return operation(sig, statistic, out=out)
 
 
-def derivative(x, y, method='forward'):
+def derivative(x, y, method='forward', axis=-1, n=1, accuracy=None):
     '''Returns the derivative of y with respect to x.
 
     Parameters
     ----------
-    x : ndarray, shape(n,)
-    y : ndarray, shape(n,)
+    x : ndarray, shape(m,)
+        The samples do not have to be evenly spaced.
+    y : ndarray, shape(m,) or shape(..., m, ...)
     method : string, optional
         'forward'
            Use the forward difference method.
@@ -587,35 +2767,524 @@ def derivative(x, y, method='forward'):
         'backward'
           Use the backward difference method.
         'combination'
-          Use forward on the first point, backward on the last and central
+          Use forward on the first points, backward on the last and central
           on the rest.
+    axis : int, optional, default=-1
+        The axis of y to differentiate along.
+    n : int, optional, default=1
+        The order of the derivative, e.g. 2 for the second derivative.
+    accuracy : int, optional, default=None
+        The order of accuracy of the difference stencils for evenly spaced
+        samples. This must be even for the 'central' and 'combination'
+        methods. Defaults to 1 for 'forward' and 'backward' and to 2 for
+        'central' and 'combination'.
 
     Returns
     -------
-    dydx : ndarray, shape(n,) or shape(n-1,)
-        for combination else shape(n-1,)
+    dydx : ndarray, shape(m,) or shape(m-k,)
+        shape(m,) for combination else shape(m-k,) where k is the number of
+        points in the stencil minus one, e.g. shape(m-1,) for the first order
+        forward and backward differences and shape(m-2,) for the second
+        order central differences. The forward differences are at x[:m-k],
+        the backward differences at x[k:] and the central differences at
+        x[k/2:m-k/2].
 
     '''
+    if method in ['forward', 'backward']:
+        if accuracy is None:
+            accuracy = 1
+        width = accuracy + n
+    elif method in ['central', 'combination']:
+        if accuracy is None:
+            accuracy = 2
+        if accuracy % 2 != 0:
+            raise ValueError('The accuracy must be even for the {} '
+                             'method.'.format(method))
+        width = accuracy + 1 + 2 * ((n - 1) // 2)
+    else:
+        raise ValueError("There is no {} method here! Only 'forward', "
+                         "'backward', 'central' and 'combination' are "
+                         "available.".format(method))
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y)
+    axis = axis % y.ndim
+    # the differentiated axis is last from here on
+    y = np.rollaxis(y, axis, y.ndim)
+
+    m = len(x)
+    if y.shape[-1] != m:
+        raise ValueError('x must be the same length as y along axis.')
+    if width > m:
+        raise ValueError('At least {} samples are needed.'.format(width))
+
     if method == 'forward':
-        return np.diff(y) / np.diff(x)
-    elif method == 'combination':
-        dxdy = np.zeros_like(y)
-        for i, yi in enumerate(y[:]):
-            if i == 0:
-                dxdy[i] = (-3 * y[0] + 4 * y[1] - y[2])\
-                          / 2 / (x[1] - x[0])
-            elif i == len(y) - 1:
-                dxdy[-1] = (3 * y[-1] - 4 * y[-2] + y[-3])\
-                           / 2 / (x[-1] - x[-2])
-            else:
-                dxdy[i] = (y[i + 1] - y[i - 1]) / 2 / (x[i] - x[i - 1])
-        return dxdy
+        dydx = _stencil_derivative(x, y, 0, m - width + 1, width, 0, n)
+    elif method == 'backward':
+        dydx = _stencil_derivative(x, y, 0, m - width + 1, width, width - 1,
+                                   n)
     else:
-        raise NotImplementedError("There is no %s method here! Only 'forward'\
-            and 'combination' are currently available." % method)
+        half = (width - 1) // 2
+        dydx = _stencil_derivative(x, y, 0, m - width + 1, width, half, n)
+        if method == 'combination':
+            # the ends use stencils that lie inside the data, which need one
+            # more point for the same accuracy
+            edge = min(accuracy + n, m)
+            first = [_stencil_derivative(x, y, 0, 1, edge, i, n)
+                     for i in range(half)]
+            last = [_stencil_derivative(x, y, m - edge, 1, edge,
+                                        edge - half + i, n)
+                    for i in range(half)]
+            dydx = np.concatenate(first + [dydx] + last, axis=-1)
+
+    return np.rollaxis(dydx, dydx.ndim - 1, axis)
+
+
+def _stencil_derivative(x, y, first, num, width, position, n,
+                        block_size=2 ** 16):
+    '''Returns the n-th derivative of y, along its last axis, at num points
+    using finite difference stencils of width samples. The stencil for the
+    i-th point starts at sample first + i and the point is at sample first +
+    i + position. The stencil weights are found by requiring the difference
+    formula to be exact for polynomials of degree width - 1, for evenly
+    spaced x they are the same at every point.'''
+
+    def weights(offsets):
+        # solve sum(w * d ** p) = n! * delta(p, n) for p = 0...width - 1 for
+        # each row of offsets, scaled by their largest value for conditioning
+        scale = np.abs(offsets).max(axis=-1)[..., np.newaxis]
+        powers = (offsets / scale)[..., np.newaxis, :] ** \
+            np.arange(width)[:, np.newaxis]
+        rhs = np.zeros(offsets.shape[:-1] + (width,))
+        rhs[..., n] = np.prod(np.arange(1, n + 1))
+        return np.linalg.solve(powers, rhs) / scale ** n
+
+    spacing = np.diff(x[first:first + num + width - 1])
+    if np.allclose(spacing, spacing.mean(), rtol=1e-10, atol=0.0):
+        w = weights((np.arange(width) - position) * spacing.mean())
+    else:
+        w = np.empty((num, width))
+        for start in range(0, num, block_size):
+            stop = min(start + block_size, num)
+            samples = first + np.arange(start, stop)
+            offsets = x[samples[:, np.newaxis] + np.arange(width)] - \
+                x[samples + position][:, np.newaxis]
+            w[start:stop] = weights(offsets)
+
+    # the weights are either the same at every point, shape(width,), or
+    # shape(num, width)
+    w = w.T
+    dydx = w[0] * y[..., first:first + num]
+    for j in range(1, width):
+        dydx += w[j] * y[..., first + j:first + j + num]
+
+    return dydx
+
+
+def smooth_derivatives(data, samplerate, window_length, polyorder=3,
+                       axis=-1):
+    '''Returns the smoothed data and its first and second derivatives with
+    respect to time, found together with a Savitzky-Golay filter.
+
+    Parameters
+    ----------
+    data : ndarray, shape(n,) or shape(..., n, ...)
+        The evenly sampled data.
+    samplerate : float
+        The sample rate of the data in hertz.
+    window_length : int
+        The odd number of samples in each local polynomial fit.
+    polyorder : int, optional, default=3
+        The order of the local polynomials, it must be less than
+        window_length. The second derivative is zero for orders less than 2.
+    axis : int, optional, default=-1
+        The time axis of data.
+
+    Returns
+    -------
+    smoothed : ndarray, shape(n,) or shape(..., n, ...)
+        The smoothed data.
+    first : ndarray, shape(n,) or shape(..., n, ...)
+        The first derivative of the smoothed data.
+    second : ndarray, shape(n,) or shape(..., n, ...)
+        The second derivative of the smoothed data.
+
+    Notes
+    -----
+    This replaces butterworth followed by derivative. Each output is one
+    compiled correlation of the data with the filter's weights, like
+    scipy.signal.savgol_filter, but the three filters share one fit. The
+    samples within window_length // 2 of the ends are found from the
+    polynomial fit to the first or last window. Use SmoothDerivatives to
+    process data in chunks.
+
+    '''
+    data = np.asarray(data, dtype=float)
+    axis = axis % data.ndim
+
+    smoother = SmoothDerivatives(samplerate, window_length,
+                                 polyorder=polyorder)
+    data = np.rollaxis(data, axis, data.ndim)
+    num_samples = data.shape[-1]
+    if num_samples < window_length:
+        raise ValueError('At least window_length samples are needed.')
+
+    # the samples at the ends are written around the full windows
+    half = window_length // 2
+    results = np.empty((3,) + data.shape)
+    _apply_weights(data, smoother._center, num_samples - 2 * half,
+                   out=results[..., half:num_samples - half])
+    for i, w in enumerate(smoother._start_edge):
+        _apply_weights(data, w, 1, out=results[..., i:i + 1])
+    last = data[..., -window_length:]
+    for i, w in enumerate(smoother._end_edge):
+        j = num_samples - half + i
+        _apply_weights(last, w, 1, out=results[..., j:j + 1])
+
+    return tuple(np.rollaxis(result, data.ndim - 1, axis) for result in
+                 results)
+
+
+class SmoothDerivatives(object):
+    '''Smooths and differentiates data that arrives in chunks with a
+    Savitzky-Golay filter, see smooth_derivatives.'''
+
+    def __init__(self, samplerate, window_length, polyorder=3):
+        '''Returns a SmoothDerivatives object.
+
+        Parameters
+        ----------
+        samplerate : float
+            The sample rate of the data in hertz.
+        window_length : int
+            The odd number of samples in each local polynomial fit.
+        polyorder : int, optional, default=3
+            The order of the local polynomials, it must be less than
+            window_length.
+
+        '''
+        window_length = int(window_length)
+        if window_length % 2 != 1 or window_length < 1:
+            raise ValueError('window_length must be a positive odd number.')
+        if not 0 <= polyorder < window_length:
+            raise ValueError('polyorder must be less than window_length.')
+
+        self.window_length = window_length
+        self.polyorder = int(polyorder)
+        self.samplerate = float(samplerate)
+
+        half = window_length // 2
+        # The polynomial coefficients of the least squares fit to a window
+        # are fit.dot(window), where the polynomial is in powers of the
+        # sample number relative to the center of the window.
+        powers = np.arange(self.polyorder + 1)
+        vandermonde = (np.arange(window_length)[:, np.newaxis] - half) ** \
+            powers
+        fit = np.linalg.pinv(vandermonde)
+
+        def weights(position):
+            # the weights for the value and the first two derivatives at a
+            # position in the window, shape(3, window_length)
+            t = float(position - half)
+            w = np.zeros((3, window_length))
+            for k in powers:
+                w[0] += fit[k] * t ** k
+                if k >= 1:
+                    w[1] += fit[k] * k * t ** (k - 1)
+                if k >= 2:
+                    w[2] += fit[k] * k * (k - 1) * t ** (k - 2)
+            # convert from per sample to per second
+            w[1] *= self.samplerate
+            w[2] *= self.samplerate ** 2
+            return w
+
+        self._center = weights(half)
+        self._start_edge = [weights(p) for p in range(half)]
+        self._end_edge = [weights(p) for p in range(half + 1, window_length)]
+
+        self._buffer = None
+        self._started = False
+
+    def update(self, chunk):
+        '''Adds the next chunk of data and returns the smoothed data and
+        derivatives for all of the samples whose windows are complete.
+
+        Parameters
+        ----------
+        chunk : array_like, shape(..., m)
+            The next samples, with time along the last axis.
+
+        Returns
+        -------
+        smoothed : ndarray, shape(..., p)
+            The smoothed data.
+        first : ndarray, shape(..., p)
+            The first derivative.
+        second : ndarray, shape(..., p)
+            The second derivative.
+
+        '''
+        chunk = np.asarray(chunk, dtype=float)
+        if self._buffer is None:
+            buffer = chunk
+        else:
+            buffer = np.concatenate((self._buffer, chunk), axis=-1)
+
+        width = self.window_length
+        num = buffer.shape[-1] - width + 1
 
+        if num <= 0:
+            self._buffer = buffer.copy()
+            return tuple(np.zeros(buffer.shape[:-1] + (0,)) for i in
+                         range(3))
 
-def time_vector(num_samples, sample_rate, start_time=0.0):
+        if self._started:
+            results = _apply_weights(buffer, self._center, num)
+        else:
+            # the samples before the first full window come first
+            half = len(self._start_edge)
+            results = np.empty((3,) + buffer.shape[:-1] + (half + num,))
+            for i, w in enumerate(self._start_edge):
+                _apply_weights(buffer, w, 1, out=results[..., i:i + 1])
+            _apply_weights(buffer, self._center, num,
+                           out=results[..., half:])
+            self._started = True
+
+        # keep the samples the next windows need, the last window of the
+        # data is handled by finish
+        self._buffer = buffer[..., num:].copy()
+        self._last = buffer[..., -width:].copy()
+
+        return tuple(results)
+
+    def finish(self):
+        '''Returns the smoothed data and derivatives for the samples at the
+        end of the data, whose windows are not complete.
+
+        Returns
+        -------
+        smoothed : ndarray, shape(..., window_length // 2)
+            The smoothed data.
+        first : ndarray, shape(..., window_length // 2)
+            The first derivative.
+        second : ndarray, shape(..., window_length // 2)
+            The second derivative.
+
+        '''
+        if not self._started:
+            raise ValueError('At least window_length samples are needed.')
+
+        edge = [_apply_weights(self._last, w, 1) for w in self._end_edge]
+        if len(edge) == 0:
+            return tuple(np.zeros(self._last.shape[:-1] + (0,)) for i in
+                         range(3))
+        return tuple(np.concatenate(edge, axis=-1))
+
+
+def _apply_weights(data, weights, num, out=None):
+    '''Returns the filters with the rows of weights, shape(k, width),
+    applied to num windows of data along its last axis, stacked along a
+    new first axis, shape(k, ..., num), in out if it is given. Each filter
+    is one compiled correlation over each channel of the data.'''
+    width = weights.shape[1]
+    if out is None:
+        out = np.empty((len(weights),) + data.shape[:-1] + (num,))
+    if num == 1:
+        window = data[..., :width]
+        out[..., 0] = np.rollaxis(np.dot(window, weights.T), -1, 0)
+        return out
+    for channel in np.ndindex(data.shape[:-1]):
+        for result, w in zip(out, weights):
+            result[channel] = np.correlate(data[channel][:num + width - 1],
+                                           w, mode='valid')
+    return out
+
+
+class TimeBase(object):
+    """An evenly sampled time vector that is described by its start time,
+    sample rate and number of samples, and only computes its values when
+    they are needed.
+
+    Indexing with an integer returns a time, with a slice returns another
+    TimeBase and with an array returns an array of times. Adding or
+    subtracting a scalar shifts the times and multiplying by a positive
+    scalar scales them, both without computing the values. Functions that
+    expect an array, e.g. numpy.interp, get the values through
+    numpy.asarray.
+
+    """
+
+    # makes NumPy scalars defer to the arithmetic methods below
+    __array_priority__ = 100.0
+
+    def __init__(self, start, rate, length):
+        """Returns a TimeBase object.
+
+        Parameters
+        ----------
+        start : float
+            The time of the first sample.
+        rate : float
+            The sample rate in hertz.
+        length : int
+            The number of samples.
+
+        """
+        if rate <= 0.0:
+            raise ValueError('The sample rate must be positive.')
+        self.start = float(start)
+        self.rate = float(rate)
+        self.length = int(length)
+
+    def __repr__(self):
+        return 'TimeBase(start={!r}, rate={!r}, length={!r})'.format(
+            self.start, self.rate, self.length)
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        return (isinstance(other, TimeBase) and
+                (self.start, self.rate, self.length) ==
+                (other.start, other.rate, other.length))
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def stop(self):
+        """The time of the last sample."""
+        return self._time(self.length - 1)
+
+    def _time(self, index):
+        return self.start + index / self.rate
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step < 0:
+                raise ValueError('A TimeBase can not be reversed.')
+            length = max(0, -(-(stop - start) // step))
+            return TimeBase(self._time(start), self.rate / step, length)
+        elif np.isscalar(key):
+            index = int(key)
+            if index < 0:
+                index += self.length
+            if not 0 <= index < self.length:
+                raise IndexError('The index is out of range.')
+            return self._time(index)
+        else:
+            return self.values()[key]
+
+    def values(self, dtype=np.float64):
+        """Returns the times as an array, shape(length,)."""
+        return (self.start + np.arange(self.length) / self.rate).astype(dtype)
+
+    def __array__(self, dtype=None):
+        return self.values(np.float64 if dtype is None else dtype)
+
+    def index(self, time):
+        """Returns the fractional sample index of a time or array of times."""
+        return (np.asarray(time) - self.start) * self.rate
+
+    def searchsorted(self, time, side='left'):
+        """Returns the index where a time would be inserted to keep the
+        times sorted, as numpy.searchsorted does."""
+        if side not in ('left', 'right'):
+            raise ValueError("side must be 'left' or 'right'.")
+        index = min(max(int(np.ceil(self.index(time))), 0), self.length)
+        # correct the estimate for round off in the index
+        before = (lambda t: t < time) if side == 'left' else \
+            (lambda t: t <= time)
+        while index > 0 and not before(self._time(index - 1)):
+            index -= 1
+        while index < self.length and before(self._time(index)):
+            index += 1
+        return index
+
+    def interp(self, time, values):
+        """Returns the linear interpolation of values sampled on this time
+        base at the given times, as numpy.interp(time, self, values) does.
+
+        Parameters
+        ----------
+        time : float or array_like or TimeBase
+            The times to interpolate at.
+        values : array_like, shape(length,)
+            The sampled values.
+
+        Returns
+        -------
+        interpolated : float or ndarray
+            The interpolated values.
+
+        Notes
+        -----
+        If time is a TimeBase with the same rate, e.g. this one shifted,
+        every time is the same fraction of a sample past a sample of this
+        one, so the result is a weighted sum of two slices of values and no
+        times or indices are computed. Otherwise this is numpy.interp.
+
+        """
+        values = np.asarray(values)
+        if len(values) != self.length:
+            raise ValueError('There must be one value per sample.')
+
+        if not isinstance(time, TimeBase) or time.rate != self.rate or \
+                self.length < 2:
+            if isinstance(time, TimeBase):
+                time = time.values()
+            return np.interp(time, self.values(), values)
+
+        offset = self.index(time.start)
+        lower = int(np.floor(offset))
+        fraction = offset - lower
+        if fraction == 0.0:
+            # the times are samples, so the last one can be used too
+            lower, fraction = lower - 1, 1.0
+
+        # the times in the range of this time base, the rest are clamped to
+        # the end values as numpy.interp does
+        first = min(max(0, -lower), time.length)
+        last = max(min(time.length, self.length - 1 - lower), first)
+
+        interpolated = np.empty(time.length, dtype=np.result_type(
+            values.dtype, np.float64))
+        interpolated[:first] = values[0]
+        interpolated[last:] = values[-1]
+        middle = interpolated[first:last]
+        np.multiply(values[lower + first:lower + last], 1.0 - fraction,
+                    out=middle)
+        middle += fraction * values[lower + first + 1:lower + last + 1]
+        return interpolated
+
+    def __add__(self, other):
+        if np.size(other) == 1:
+            return TimeBase(self.start + float(np.ravel(other)[0]),
+                            self.rate, self.length)
+        return self.values() + other
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if np.size(other) == 1:
+            return self + (-float(np.ravel(other)[0]))
+        return self.values() - other
+
+    def __rsub__(self, other):
+        return other - self.values()
+
+    def __mul__(self, other):
+        if np.size(other) == 1 and float(np.ravel(other)[0]) > 0.0:
+            factor = float(np.ravel(other)[0])
+            return TimeBase(self.start * factor, self.rate / factor,
+                            self.length)
+        return self.values() * other
+
+    __rmul__ = __mul__
+
+
+def time_vector(num_samples, sample_rate, start_time=0.0, lazy=False):
     '''Returns a time vector starting at zero.
 
     Parameters
@@ -626,10 +3295,13 @@ def time_vector(num_samples, sample_rate, start_time=0.0):
         Sample rate of the signal in hertz.
     start_time : float, optional, default=0.0
         The start time of the time series.
+    lazy : boolean, optional, default=False
+        If true, a TimeBase is returned instead of an array, which doesn't
+        allocate the values.
 
     Returns
     -------
-    time : ndarray, shape(numSamples,)
+    time : ndarray, shape(numSamples,) or TimeBase
         Time vector starting at zero.
 
     '''
@@ -637,4 +3309,146 @@ def time_vector(num_samples, sample_rate, start_time=0.0):
     ns = num_samples
     sr = float(sample_rate)
 
+    if lazy is True:
+        return TimeBase(start_time, sr, ns)
+
     return np.linspace(start_time, (ns - 1) / sr + start_time, num=ns)
+
+
+def load_csv(path, delimiter=',', skiprows=0, header=False,
+             time_column=None, sample_rate=None, cache_dir=None,
+             chunk_size=100000):
+    """Returns the numeric data in a delimited text file as a read only
+    memory map of a binary cache, which is created on the first call and
+    recreated whenever the text file changes.
+
+    Parameters
+    ----------
+    path : string
+        The path to the text file, with one row per sample.
+    delimiter : string, optional, default=','
+        The string that separates the columns.
+    skiprows : int, optional, default=0
+        The number of lines to skip at the start of the file.
+    header : boolean, optional, default=False
+        If true, the first line after the skipped lines holds the column
+        names.
+    time_column : int or string, optional, default=None
+        The index or name of a column holding the sample times. If given,
+        the start time and sample rate are computed from it.
+    sample_rate : float, optional, default=None
+        The sample rate in hertz, for files without a time column.
+    cache_dir : string, optional, default=None
+        The directory for the cache files. Defaults to the directory of the
+        text file.
+    chunk_size : int, optional, default=100000
+        The number of rows parsed at once when the cache is created.
+
+    Returns
+    -------
+    data : numpy.memmap, shape(n, m)
+        The data, which is read from disk as it is accessed.
+    metadata : dictionary
+        The 'columns' names, the 'sample_rate' and 'start_time', None if
+        unknown, and whether the time column is 'evenly_sampled', along with
+        the source file's size and modification time and the arguments used
+        to parse it. TimeBase(metadata['start_time'],
+        metadata['sample_rate'], len(data)) is the time base of the data.
+
+    Notes
+    -----
+    The data is stored as a NumPy .npy file and the metadata as JSON, named
+    after the text file with '.npy' and '.json' appended. The cache is
+    recreated if the size or modification time of the text file, or the
+    arguments, differ from those in the metadata.
+
+    """
+    path = os.path.abspath(path)
+    if cache_dir is None:
+        cache_dir = os.path.dirname(path)
+    base = os.path.join(cache_dir, os.path.basename(path))
+    data_path, metadata_path = base + '.npy', base + '.json'
+
+    status = os.stat(path)
+    source = {'path': path, 'size': status.st_size,
+              'mtime': status.st_mtime, 'delimiter': delimiter,
+              'skiprows': skiprows, 'header': header,
+              'time_column': time_column, 'sample_rate': sample_rate}
+
+    try:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        if metadata['source'] != source:
+            raise ValueError('The cache is out of date.')
+        data = np.load(data_path, mmap_mode='r')
+    except (IOError, OSError, ValueError, KeyError):
+        metadata = _build_csv_cache(path, data_path, metadata_path, source,
+                                    chunk_size)
+        data = np.load(data_path, mmap_mode='r')
+
+    return data, metadata
+
+
+def _build_csv_cache(path, data_path, metadata_path, source, chunk_size):
+    """Parses a text file into a .npy file and writes its JSON metadata,
+    see load_csv. Returns the metadata."""
+
+    delimiter = source['delimiter']
+
+    def data_lines(f):
+        lines = islice(f, source['skiprows'], None)
+        # skip blank lines, as numpy.loadtxt does
+        return (line for line in lines if line.strip())
+
+    with open(path) as f:
+        lines = data_lines(f)
+        columns = next(lines).strip().split(delimiter) if source['header'] \
+            else None
+        first = next(lines, None)
+        num_rows = 0 if first is None else 1 + sum(1 for line in lines)
+
+    num_columns = 0 if first is None else len(first.split(delimiter))
+    if columns is None:
+        columns = [str(i) for i in range(num_columns)]
+    columns = [column.strip() for column in columns]
+
+    # write to a temporary file first, so an interrupted build never leaves
+    # a cache that looks valid
+    temporary_path = data_path + '.tmp'
+    data = np.lib.format.open_memmap(temporary_path, mode='w+',
+                                     dtype=np.float64,
+                                     shape=(num_rows, num_columns))
+    with open(path) as f:
+        lines = data_lines(f)
+        if source['header']:
+            next(lines)
+        for start in range(0, num_rows, chunk_size):
+            chunk = list(islice(lines, chunk_size))
+            data[start:start + len(chunk)] = np.loadtxt(
+                chunk, delimiter=delimiter, ndmin=2)
+
+    metadata = {'source': source, 'columns': columns,
+                'sample_rate': source['sample_rate'], 'start_time': None,
+                'evenly_sampled': None}
+
+    time_column = source['time_column']
+    if time_column is not None and num_rows > 1:
+        if not isinstance(time_column, int):
+            time_column = columns.index(time_column)
+        time = data[:, time_column]
+        duration = time[-1] - time[0]
+        metadata['start_time'] = float(time[0])
+        metadata['sample_rate'] = float((num_rows - 1) / duration)
+        # the times are within 1% of a sample of an even spacing
+        even = np.linspace(time[0], time[-1], num=num_rows)
+        metadata['evenly_sampled'] = bool(np.max(np.abs(time - even)) <
+                                          0.01 * duration / (num_rows - 1))
+
+    del data  # flushes and closes the memory map
+    os.rename(temporary_path, data_path)
+
+    with open(metadata_path + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+    os.rename(metadata_path + '.tmp', metadata_path)
+
+    return metadata
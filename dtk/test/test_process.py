@@ -3,17 +3,168 @@
 
 # standard library
 import os
+import shutil
+import tempfile
 from distutils.version import LooseVersion
 
 # external libraries
 import numpy as np
 from numpy import testing
 from scipy import __version__ as scipy_version
+from scipy.interpolate import interp1d
+from scipy.signal import butter, filtfilt, welch
+from scipy import sparse
 
 # local libraries
 from .. import process
 
 
+def test_curve_area_stats():
+
+    x = np.linspace(0.0, 10.0, 1001)
+    # a flat curve, a ramp and a curve with no area
+    y = np.vstack((np.ones_like(x), x, np.zeros_like(x))).T
+
+    xstats = process.curve_area_stats(x, y)
+    assert xstats.shape == (3,)
+    testing.assert_allclose(xstats['median'][:2], [5.0, np.sqrt(50.0)],
+                            atol=0.011)
+    testing.assert_allclose(xstats['lq'][:2], [2.5, np.sqrt(25.0)],
+                            atol=0.011)
+    testing.assert_allclose(xstats['98p'][:2], [9.8, np.sqrt(98.0)],
+                            atol=0.011)
+    assert np.isnan(xstats[2]['median'])
+
+    xstats = process.curve_area_stats(x, y, percentiles=[10.0, 62.5],
+                                      interpolate=True)
+    assert xstats.dtype.names == ('p10', 'p62.5')
+    testing.assert_allclose(xstats['p10'][:2], [1.0, np.sqrt(10.0)],
+                            rtol=1e-4)
+    testing.assert_allclose(xstats['p62.5'][:2], [6.25, np.sqrt(62.5)],
+                            rtol=1e-4)
+
+
+def test_freq_spectrum():
+
+    sample_rate = 1000.0
+    time = np.arange(2 ** 14) / sample_rate
+    np.random.seed(0)
+    signal = 3.0 * np.sin(2.0 * np.pi * 125.0 * time)
+    noisy = signal + np.random.randn(len(time))
+
+    frequency, amplitude = process.freq_spectrum(signal, sample_rate)
+    assert frequency.shape == amplitude.shape == (2 ** 13 - 1,)
+    testing.assert_allclose(frequency[np.argmax(amplitude)], 125.0)
+    testing.assert_allclose(amplitude.max(), 3.0)
+
+    # channels along the first axis
+    data = np.vstack((signal, noisy, noisy)).T
+    frequency, amplitude = process.freq_spectrum(data, sample_rate, axis=0)
+    assert amplitude.shape == (2 ** 13 - 1, 3)
+
+    # single precision
+    frequency, amplitude32 = process.freq_spectrum(data.astype(np.float32),
+                                                   sample_rate, axis=0)
+    assert amplitude32.dtype == np.float32
+    testing.assert_allclose(amplitude32, amplitude, atol=1e-5)
+
+    frequency, amplitude = process.freq_spectrum(noisy, sample_rate,
+                                                 method='welch', nperseg=1000)
+    assert frequency.shape == amplitude.shape == (499,)
+    testing.assert_allclose(frequency[np.argmax(amplitude)], 125.0)
+    testing.assert_allclose(amplitude.max(), 3.0, rtol=0.01)
+    # averaging reduces the variance of the noise floor
+    assert np.std(amplitude[frequency > 200.0]) < 0.01
+
+
+def test_streaming_stft():
+
+    sample_rate = 1000.0
+    np.random.seed(0)
+    data = np.random.randn(2, 10000)
+
+    stft = process.StreamingSTFT(sample_rate, nperseg=500, noverlap=100)
+    num_frames = stft.num_frames(data.shape[-1])
+    assert num_frames == 24
+
+    directory = tempfile.mkdtemp()
+    try:
+        out = np.memmap(os.path.join(directory, 'frames.bin'), dtype=float,
+                        mode='w+',
+                        shape=(num_frames, len(stft.frequency), 2))
+
+        chunks = [data[:, i:i + 777] for i in range(0, data.shape[-1], 777)]
+        times = [time for time, amplitude in stft.frames(chunks, out=out)]
+
+        testing.assert_allclose(times, (np.arange(num_frames) * 400 + 249.5) /
+                                sample_rate)
+
+        # the frames average to the Welch spectrum with the same segments
+        frequency, amplitude = process.freq_spectrum(data, sample_rate,
+                                                     method='welch',
+                                                     nperseg=500,
+                                                     noverlap=100)
+        testing.assert_allclose(stft.frequency, frequency)
+        testing.assert_allclose(np.sqrt(np.mean(out ** 2, axis=0)),
+                                amplitude)
+        del out
+    finally:
+        shutil.rmtree(directory)
+
+    stft = process.StreamingSTFT(sample_rate, nperseg=500, dtype=np.float32)
+    frames = [amplitude.copy() for time, amplitude in
+              stft.update(data[0].astype(np.float32))]
+    assert len(frames) == 39
+    assert frames[0].dtype == np.float32
+
+    # chunks are added even if their frames aren't consumed, and a frame is
+    # yielded once even if the consumer stops early
+    expected = list(process.StreamingSTFT(sample_rate, nperseg=500).update(
+        data[0]))
+    stft = process.StreamingSTFT(sample_rate, nperseg=500)
+    stft.update(list(data[0, :1000]))
+    frames = []
+    for frame in stft.update(data[0, 1000:4000]):
+        frames.append(frame)
+        if len(frames) == 3:
+            break
+    frames.extend(stft.update(data[0, 4000:]))
+    assert len(frames) == len(expected)
+    for (time, amplitude), (expected_time, expected_amplitude) in zip(
+            frames, expected):
+        assert time == expected_time
+        testing.assert_allclose(amplitude, expected_amplitude)
+
+
+def test_running_psd():
+
+    sample_rate = 1000.0
+    np.random.seed(0)
+    data = np.random.randn(10000)
+
+    frequency, expected = welch(data, sample_rate, nperseg=500, noverlap=250)
+    expected = expected[1:250]
+
+    running = process.RunningPSD(sample_rate, nperseg=500, noverlap=250)
+    for i in range(0, len(data), 333):
+        running.update(data[i:i + 333])
+    testing.assert_allclose(running.psd()[1], expected)
+    testing.assert_allclose(running.psd()[0], frequency[1:250])
+
+    # split the signal on a segment boundary and merge the estimates
+    first = process.RunningPSD(sample_rate, nperseg=500, noverlap=250)
+    first.update(data[:5250])
+    second = process.RunningPSD(sample_rate, nperseg=500, noverlap=250)
+    second.update(data[5000:])
+    merged = first.merge(second)
+    assert merged.count == running.count
+    testing.assert_allclose(merged.psd()[1], expected)
+
+    testing.assert_raises(ValueError, first.merge,
+                          process.RunningPSD(sample_rate, nperseg=256))
+    testing.assert_raises(ValueError, process.RunningPSD(sample_rate).psd)
+
+
 def test_butterworth():
 
     nine = LooseVersion('0.9.0')
@@ -69,6 +220,171 @@ def test_butterworth():
         testing.assert_allclose(filtered, expected, rtol=1e-5, atol=1e-3)
 
 
+def test_butterworth_nd():
+
+    np.random.seed(0)
+    # shape(trials, channels, samples)
+    data = np.random.randn(3, 5, 2001)
+
+    expected = np.zeros_like(data)
+    for i in range(3):
+        expected[i] = process.butterworth(data[i], 20.0, 200.0, order=4)
+
+    testing.assert_allclose(process.butterworth(data, 20.0, 200.0, order=4),
+                            expected)
+    testing.assert_allclose(process.butterworth(data, 20.0, 200.0, order=4,
+                                                threads=4), expected)
+
+    # along the first axis
+    data = np.random.randn(2001, 2, 3)
+    expected = process.butterworth(data.reshape(2001, 6), 20.0, 200.0,
+                                   order=4, axis=0).reshape(data.shape)
+    filtered = process.butterworth(data, 20.0, 200.0, order=4, axis=0,
+                                   threads=2)
+    testing.assert_allclose(filtered, expected)
+
+
+def test_butterworth_sos():
+
+    time = np.linspace(0.0, 100.0, 100001)
+    sample_rate = 1000.0
+
+    low_freq = np.sin(0.2 * 2.0 * np.pi * time)
+    high_freq = np.sin(50.0 * 2.0 * np.pi * time)
+
+    # the transfer function form of this filter is unstable
+    filtered = process.butterworth(low_freq + high_freq, 2.0, sample_rate,
+                                   order=8)
+    testing.assert_allclose(filtered[5000:-5000], low_freq[5000:-5000],
+                            atol=1e-5)
+
+    # both forms agree for well conditioned filters
+    sos = process.butterworth(low_freq + high_freq, 100.0, sample_rate,
+                              order=4, padlen=150)
+    ba = process.butterworth(low_freq + high_freq, 100.0, sample_rate,
+                             order=4, padlen=150, output='ba')
+    testing.assert_allclose(sos, ba, atol=1e-8)
+
+    # the designs are cached
+    assert (process._butter_coefficients(4, 0.2, 'lowpass', 'sos') is
+            process._butter_coefficients(4, 0.2, 'lowpass', 'sos'))
+
+
+def test_butterworth_chunked():
+
+    np.random.seed(0)
+    data = np.random.randn(10007, 3)
+
+    expected = process.butterworth(data, 10.0, 100.0, order=4, axis=0)
+
+    directory = tempfile.mkdtemp()
+    try:
+        source = np.memmap(os.path.join(directory, 'data.bin'),
+                           dtype=float, mode='w+', shape=data.shape)
+        source[:] = data
+        out = np.memmap(os.path.join(directory, 'out.bin'), dtype=float,
+                        mode='w+', shape=data.shape)
+
+        filtered = process.butterworth(source, 10.0, 100.0, order=4, axis=0,
+                                       out=out, chunk_size=1000)
+        assert filtered is out
+        testing.assert_allclose(out, expected, rtol=1e-12, atol=1e-12)
+        del source, out, filtered
+    finally:
+        shutil.rmtree(directory)
+
+    expected = process.butterworth(data.T, 10.0, 100.0, order=4, padlen=150)
+    filtered = process.butterworth(data.T, 10.0, 100.0, order=4,
+                                   chunk_size=333, padlen=150)
+    testing.assert_allclose(filtered, expected, rtol=1e-12, atol=1e-12)
+
+    testing.assert_raises(ValueError, process.butterworth, data, 10.0, 100.0,
+                          chunk_size=100, padtype='even')
+
+    # no extensions of the ends, as filtfilt with padlen=0
+    b, a = butter(4, 0.2)
+    expected = filtfilt(b, a, data, axis=0, padlen=0)
+    for kwargs in [{}, {'chunk_size': 1000}, {'output': 'ba'}]:
+        filtered = process.butterworth(data, 10.0, 100.0, order=4, axis=0,
+                                       padlen=0, **kwargs)
+        testing.assert_allclose(filtered, expected, rtol=1e-10, atol=1e-10)
+
+
+def test_butterworth_filtfilt_kwargs():
+
+    np.random.seed(0)
+    data = np.random.randn(1000)
+    b, a = butter(4, 0.2)
+
+    # arguments that the second-order sections can't take use filtfilt
+    for kwargs in [{'padtype': 'even'}, {'padtype': None},
+                   {'method': 'gust'}]:
+        expected = filtfilt(b, a, data, **kwargs)
+        filtered = process.butterworth(data, 10.0, 100.0, order=4, **kwargs)
+        testing.assert_allclose(filtered, expected, rtol=1e-8, atol=1e-8)
+
+
+def test_resample():
+
+    time = process.time_vector(2000, 1000.0)
+    signal = np.sin(2.0 * np.pi * 7.0 * time)
+
+    for new_rate in [100.0, 240.0, 3000.0]:
+        resampled = process.resample(signal, 1000.0, new_rate)
+        assert len(resampled) == 2 * new_rate
+        new_time = process.time_vector(len(resampled), new_rate)
+        # the ends are attenuated by the zero padding
+        interior = slice(len(resampled) // 10, -len(resampled) // 10)
+        testing.assert_allclose(resampled[interior],
+                                np.sin(2.0 * np.pi * 7.0 *
+                                       new_time[interior]), atol=2e-3)
+
+    data = np.random.random((3, 500, 2))
+    resampled = process.resample(data, 1000.0, 240.0, axis=1)
+    assert resampled.shape == (3, 120, 2)
+    testing.assert_allclose(resampled[1, :, 0],
+                            process.resample(data[1, :, 0], 1000.0, 240.0))
+
+    # the filter design is reused
+    assert (process._resample_filter(6, 25)[0] is
+            process._resample_filter(6, 25)[0])
+
+
+def test_resample_channels():
+
+    tau = 0.1
+
+    def signal(time):
+        return np.sin(2.0 * np.pi * 1.3 * time) + np.cos(2.0 * np.pi * 0.4 *
+                                                         time)
+
+    force_time = process.time_vector(20000, 2000.0)
+    imu_time = process.time_vector(1200, 120.0, 0.05)
+
+    time, (force, imu) = process.resample_channels(
+        [signal(force_time), signal(imu_time + tau)], [2000.0, 120.0],
+        start_times=[0.0, 0.05])
+
+    assert isinstance(time, process.TimeBase)
+    assert time.rate == 2000.0
+    testing.assert_allclose(time.start, 0.05)
+    testing.assert_allclose(time.stop, min(force_time[-1], imu_time[-1]))
+    assert len(force) == len(imu) == len(time)
+
+    interior = slice(500, -500)
+    testing.assert_allclose(force[interior], signal(time.values())[interior],
+                            atol=1e-6)
+    testing.assert_allclose(imu[interior],
+                            signal(time.values() + tau)[interior], atol=2e-3)
+
+    # the output feeds the alignment functions
+    assert (process.sync_error(tau, force[interior], imu[interior],
+                               time[interior] - time.start) < 0.1)
+    truncated_force, truncated_imu = process.truncate_data(
+        tau, force[interior], imu[interior], time.rate)
+    testing.assert_allclose(truncated_force, truncated_imu, atol=2e-3)
+
+
 def test_coefficient_of_determination():
 
     # TODO : It isn't clear to me why I can't get these results to match at
@@ -130,6 +446,123 @@ def test_coefficient_of_determination():
     testing.assert_allclose(second_r_squared, second_expected_r_squared)
 
 
+def test_batched_fit_goodness():
+
+    measured = 100.0 + np.random.randn(500, 3, 4)
+    predicted = measured + 0.1 * np.random.randn(500, 3, 4)
+
+    r_squared = process.coefficient_of_determination(measured, predicted,
+                                                     axis=0)
+    goodness = process.fit_goodness(measured, predicted, axis=0)
+    assert r_squared.shape == (3, 4)
+    for i in range(3):
+        for j in range(4):
+            testing.assert_allclose(r_squared[i, j],
+                                    process.coefficient_of_determination(
+                                        measured[:, i, j],
+                                        predicted[:, i, j]))
+            expected = process.fit_goodness(measured[:, i, j],
+                                            predicted[:, i, j])
+            for value, expected_value in zip(goodness, expected):
+                testing.assert_allclose(value[i, j], expected_value)
+
+    # accumulate on two workers and merge
+    first = process.RunningFitGoodness()
+    for start in range(0, 200, 64):
+        first.update(measured[start:min(start + 64, 200)],
+                     predicted[start:min(start + 64, 200)])
+    second = process.RunningFitGoodness().update(measured[200:],
+                                                 predicted[200:])
+    running = process.RunningFitGoodness().merge(first).merge(second)
+
+    assert running.count == 500
+    testing.assert_allclose(running.coefficient_of_determination(),
+                            r_squared)
+    for value, expected in zip(running.fit_goodness(), goodness):
+        testing.assert_allclose(value, expected, rtol=1e-8, atol=1e-8)
+
+
+def _resampled_statistics(counts, A, b):
+    # explicitly resamples the rows to check the built in statistics
+    rows = np.arange(len(b))
+    parameters = []
+    r_squared = []
+    for row_counts in counts:
+        indices = np.repeat(rows, row_counts.astype(int))
+        x = np.linalg.lstsq(A[indices], b[indices])[0]
+        parameters.append(x)
+        r_squared.append(process.coefficient_of_determination(
+            b[indices], np.dot(A[indices], x)))
+    return np.hstack((parameters, np.array(r_squared)[:, np.newaxis]))
+
+
+def _resampled_r_squared(counts, measured, predicted):
+    rows = np.arange(len(measured))
+    r_squared = []
+    for row_counts in counts:
+        indices = np.repeat(rows, row_counts.astype(int))
+        r_squared.append(process.coefficient_of_determination(
+            measured[indices], predicted[indices]))
+    return np.array(r_squared)
+
+
+def test_bootstrap():
+
+    A = np.vstack((np.random.rand(100), np.ones(100))).T
+    b = np.dot(A, [2.0, 1.0]) + 0.1 * np.random.randn(100)
+    x = np.linalg.lstsq(A, b)[0]
+    predicted = np.dot(A, x)
+
+    expected = process.bootstrap(_resampled_statistics, (A, b),
+                                 num_replicates=50, block_size=16,
+                                 processes=1, seed=12)
+    assert expected.shape == (50, 3)
+
+    parameters = process.bootstrap('least_squares', (A, b),
+                                   num_replicates=50, block_size=16,
+                                   processes=1, seed=12)
+    testing.assert_allclose(parameters, expected[:, :2])
+
+    normal = process.bootstrap('least_squares_normal', (A, b),
+                               num_replicates=50, block_size=16,
+                               processes=1, seed=12)
+    testing.assert_allclose(normal, expected[:, :2])
+
+    # the replicates don't depend on the number of processes
+    parallel = process.bootstrap('least_squares', (A, b), num_replicates=50,
+                                 block_size=16, processes=2, seed=12)
+    testing.assert_allclose(parallel, parameters)
+
+    r_squared = process.bootstrap('coefficient_of_determination',
+                                  (b, predicted), num_replicates=50,
+                                  block_size=16, processes=1, seed=12)
+    testing.assert_allclose(r_squared,
+                            process.bootstrap(_resampled_r_squared,
+                                              (b, predicted),
+                                              num_replicates=50,
+                                              block_size=16, processes=1,
+                                              seed=12))
+
+    r_squared = process.bootstrap('coefficient_of_determination',
+                                  (b, predicted), num_replicates=500,
+                                  block_size=64, processes=1, seed=3)
+    assert r_squared.shape == (500,)
+    lower, upper = process.confidence_interval(r_squared)
+    full = process.coefficient_of_determination(b, predicted)
+    assert lower < full < upper
+    testing.assert_allclose(np.median(r_squared), full, atol=0.02)
+
+    lower, upper = process.confidence_interval(parameters, confidence=0.9)
+    assert (lower < x).all() and (x < upper).all()
+
+    # several channels at once
+    channels = np.vstack((b, 2.0 * b)).T
+    r_squared = process.bootstrap('coefficient_of_determination',
+                                  (channels, 2.0 * channels),
+                                  num_replicates=10, processes=1)
+    assert r_squared.shape == (10, 2)
+
+
 def test_least_squares_variance():
 
     A = np.random.rand(3, 2)
@@ -141,6 +574,134 @@ def test_least_squares_variance():
     assert expected_variance == variance
     testing.assert_allclose(covariance, expected_covariance)
 
+    A = np.random.rand(50, 4)
+    expected_covariance = 5.0 / 46 * np.linalg.inv(np.dot(A.T, A))
+
+    R = np.linalg.qr(A, mode='r')
+    variance, covariance = process.least_squares_variance(A, 5.0, R=R)
+    testing.assert_allclose(covariance, expected_covariance)
+
+    R = np.linalg.cholesky(np.dot(A.T, A)).T
+    variance, covariance = process.least_squares_variance(A, 5.0, R=R)
+    testing.assert_allclose(covariance, expected_covariance)
+
+    svd = np.linalg.svd(A, full_matrices=False)
+    variance, covariance = process.least_squares_variance(A, 5.0, svd=svd)
+    testing.assert_allclose(covariance, expected_covariance)
+
+    variance, variances = process.least_squares_variance(A, 5.0,
+                                                         diagonal=True)
+    testing.assert_allclose(variances, np.diag(expected_covariance))
+
+    variance, block = process.least_squares_variance(A, 5.0,
+                                                     indices=[3, 1])
+    testing.assert_allclose(block, expected_covariance[[3, 1]][:, [3, 1]])
+
+
+def test_least_squares_variance_sparse():
+
+    # a block diagonal regressor, e.g. independent fits stacked together
+    A = sparse.block_diag([np.random.rand(20, 3) for i in range(10)],
+                          format='csr')
+    dense = A.toarray()
+    expected_covariance = 5.0 / (200 - 30) * np.linalg.inv(np.dot(dense.T,
+                                                                  dense))
+
+    variance, covariance = process.least_squares_variance(A, 5.0)
+    testing.assert_allclose(covariance.toarray(), expected_covariance)
+
+    variance, variances = process.least_squares_variance(A, 5.0,
+                                                         diagonal=True,
+                                                         block_size=7)
+    assert isinstance(variances, np.ndarray)
+    testing.assert_allclose(variances, np.diag(expected_covariance))
+
+    indices = [29, 0, 4]
+    variance, block = process.least_squares_variance(A, 5.0,
+                                                     indices=indices,
+                                                     block_size=2)
+    testing.assert_allclose(block,
+                            expected_covariance[indices][:, indices])
+
+    variance, variances = process.least_squares_variance(A, 5.0,
+                                                         diagonal=True,
+                                                         indices=indices)
+    testing.assert_allclose(variances,
+                            np.diag(expected_covariance)[indices])
+
+    large = sparse.identity(3000, format='csr')
+    testing.assert_raises(ValueError, process.least_squares_variance,
+                          sparse.vstack((large, large)), 5.0)
+    variance, variances = process.least_squares_variance(
+        sparse.vstack((large, large)), 5.0, diagonal=True)
+    testing.assert_allclose(variances, 5.0 / 3000 / 2.0)
+
+    # probing vectors that don't overlap within a block recover the block
+    # diagonal inverse exactly
+    probes = np.tile(np.eye(3), (10, 1))
+    variance, variances = process.least_squares_variance(A, 5.0,
+                                                         diagonal=True,
+                                                         probes=probes)
+    testing.assert_allclose(variances, np.diag(expected_covariance))
+
+    variance, variances = process.least_squares_variance(A, 5.0,
+                                                         diagonal=True,
+                                                         probes=2000)
+    testing.assert_allclose(variances, np.diag(expected_covariance),
+                            rtol=0.5)
+
+
+def test_recursive_least_squares():
+
+    A = np.random.rand(200, 4)
+    b = np.dot(A, np.array([1.0, -2.0, 3.0, 0.5])) + \
+        0.1 * np.random.randn(200)
+
+    x, residuals = np.linalg.lstsq(A, b)[:2]
+    expected_variance, expected_covariance = \
+        process.least_squares_variance(A, residuals[0])
+
+    rls = process.RecursiveLeastSquares(4, initial_covariance=1e8)
+    for row, value in zip(A[:50], b[:50]):
+        rls.update(row, value)
+    state = rls.get_state()
+    rls.update(A[50:], b[50:])
+
+    assert rls.count == 200
+    testing.assert_allclose(rls.parameters, x, rtol=1e-5)
+    variance, covariance = rls.covariance()
+    testing.assert_allclose(variance, expected_variance, rtol=1e-5)
+    testing.assert_allclose(covariance, expected_covariance, rtol=1e-5)
+    variance, variances = rls.covariance(diagonal=True)
+    testing.assert_allclose(variances, np.diag(expected_covariance),
+                            rtol=1e-5)
+
+    restored = process.RecursiveLeastSquares(4)
+    restored.set_state(state)
+    restored.update(A[50:], b[50:])
+    testing.assert_allclose(restored.parameters, rls.parameters)
+    testing.assert_allclose(restored.covariance()[1], rls.covariance()[1])
+
+    # with forgetting, a batch update matches row by row updates and the
+    # exponentially weighted least squares solution
+    batch = process.RecursiveLeastSquares(4, forgetting_factor=0.98,
+                                          initial_covariance=1e8)
+    batch.update(A, b)
+    rows = process.RecursiveLeastSquares(4, forgetting_factor=0.98,
+                                         initial_covariance=1e8)
+    for row, value in zip(A, b):
+        rows.update(row, value)
+    testing.assert_allclose(batch.parameters, rows.parameters)
+    testing.assert_allclose(batch.sum_of_residuals, rows.sum_of_residuals)
+
+    weights = np.sqrt(0.98 ** np.arange(199, -1, -1))
+    x, residuals = np.linalg.lstsq(weights[:, np.newaxis] * A,
+                                   weights * b)[:2]
+    testing.assert_allclose(batch.parameters, x, rtol=1e-5)
+    testing.assert_allclose(batch.sum_of_residuals, residuals[0],
+                            rtol=1e-5)
+
+
 def test_spline_over_nan():
     x = np.linspace(0., 50., num=300)
     y = np.sin(x) + np.random.rand(len(x))
@@ -156,6 +717,35 @@ def test_spline_over_nan():
     #plt.show()
 
 
+def test_spline_over_nan_local():
+    x = np.linspace(0., 50., num=5000)
+    y = np.vstack((np.sin(x), np.cos(x))).T
+    expected = y.copy()
+
+    y[78:89, 0] = np.nan
+    y[0, 0] = np.nan
+    y[212, 1] = np.nan
+    y[1000:1400, 1] = np.nan
+    y[-3:, 1] = np.nan
+
+    filled, unfilled = process.spline_over_nan(x, y, method='local',
+                                               max_gap=100, full_output=True)
+    assert unfilled == [(1, 1000, 1400)]
+    assert np.isnan(filled[1000:1400, 1]).all()
+    filled[1000:1400, 1] = expected[1000:1400, 1]
+    testing.assert_allclose(filled, expected, atol=1e-6)
+    # the input isn't modified
+    assert np.isnan(y[78, 0])
+
+    filled = process.spline_over_nan(x, y[:, 0], method='local')
+    testing.assert_allclose(filled, expected[:, 0], atol=1e-6)
+
+    filled, unfilled = process.spline_over_nan(x, y, full_output=True)
+    assert unfilled == []
+    assert not np.isnan(filled).any()
+    testing.assert_allclose(filled[:, 0], expected[:, 0], atol=1e-6)
+
+
 class TestTimeShift():
 
     def setup(self):
@@ -180,6 +770,44 @@ class TestTimeShift():
                                    plot=False)
         testing.assert_allclose(error, 0.0, atol=1e-8)
 
+    def test_batch_sync_error(self):
+
+        taus = np.linspace(-10.0, 10.0, 41)
+        expected = [process.sync_error(tau, self.base_signal,
+                                       self.shifted_signal, self.time)
+                    for tau in taus]
+
+        error = process.batch_sync_error(taus, self.base_signal,
+                                         self.shifted_signal, self.time,
+                                         block_size=10 * len(self.time))
+        testing.assert_allclose(error, expected)
+
+        interpolant = interp1d(self.time, self.base_signal)
+        error = process.batch_sync_error(taus, self.base_signal,
+                                         self.shifted_signal, self.time,
+                                         interpolant=interpolant)
+        testing.assert_allclose(error, expected)
+
+        testing.assert_raises(ValueError, process.batch_sync_error, [200.0],
+                              self.base_signal, self.shifted_signal,
+                              self.time)
+
+    def test_sync_error_time_base(self):
+
+        time = process.TimeBase(0.0, self.sample_rate, len(self.time))
+        for tau in [-10.3, -5.0, 0.0, 2.71]:
+            expected = process.sync_error(tau, self.base_signal,
+                                          self.shifted_signal, self.time)
+            error = process.sync_error(tau, self.base_signal,
+                                       self.shifted_signal, time)
+            testing.assert_allclose(error, expected, atol=1e-12)
+
+        error = process.batch_sync_error([-5.0, 1.0], self.base_signal,
+                                         self.shifted_signal, time)
+        testing.assert_allclose(error, process.batch_sync_error(
+            [-5.0, 1.0], self.base_signal, self.shifted_signal, self.time),
+            atol=1e-12)
+
     def test_find_time_shift(self):
 
         estimated_tau = process.find_timeshift(self.base_signal,
@@ -195,6 +823,57 @@ class TestTimeShift():
                                                plot=False)
         testing.assert_allclose(estimated_tau, self.tau, atol=0.1)
 
+        estimated_tau = process.find_timeshift(self.base_signal,
+                                               self.shifted_signal,
+                                               self.sample_rate,
+                                               method='xcorr',
+                                               plot=False)
+        testing.assert_allclose(estimated_tau, self.tau, atol=0.1)
+
+        estimated_tau = process.find_timeshift(self.base_signal,
+                                               self.shifted_signal,
+                                               self.sample_rate,
+                                               method='pyramid',
+                                               plot=False)
+        testing.assert_allclose(estimated_tau, self.tau, atol=0.1)
+
+    def test_pyramid_timeshift(self):
+
+        estimated_tau, bound = process.pyramid_timeshift(
+            self.base_signal, self.shifted_signal, self.sample_rate,
+            min_samples=256)
+        assert 0.0 < bound <= 1.5 / self.sample_rate
+        testing.assert_allclose(estimated_tau, self.tau, atol=0.1)
+
+    def test_batch_find_time_shift(self):
+
+        base_signals = [self.base_signal, self.base_signal]
+        shifted_signals = np.vstack((self.shifted_signal,
+                                     self.base_signal))
+
+        for processes in [1, 2]:
+            results = process.batch_find_timeshift(base_signals,
+                                                   shifted_signals,
+                                                   self.sample_rate,
+                                                   method='xcorr',
+                                                   processes=processes)
+            assert results.shape == (2,)
+            testing.assert_allclose(results['tau'], [self.tau, 0.0],
+                                    atol=0.1)
+            assert results['converged'].all()
+            assert (results['error'] >= 0.0).all()
+
+        results = process.batch_find_timeshift(base_signals,
+                                               shifted_signals,
+                                               [self.sample_rate] * 2,
+                                               guesses=[self.tau, None],
+                                               processes=1)
+        testing.assert_allclose(results['tau'], [self.tau, 0.0], atol=0.1)
+
+        testing.assert_raises(ValueError, process.batch_find_timeshift,
+                              base_signals, shifted_signals[:1],
+                              self.sample_rate)
+
     def test_truncate_data(self):
 
         truncated_signal1, truncated_signal2 = \
@@ -251,6 +930,28 @@ class TestTimeShiftRealData():
                                                plot=False)
         testing.assert_allclose(estimated_tau, self.tau, atol=0.1)
 
+        estimated_tau = process.find_timeshift(self.base_signal,
+                                               self.shifted_signal,
+                                               self.sample_rate,
+                                               method='xcorr',
+                                               plot=False)
+        testing.assert_allclose(estimated_tau, self.tau, atol=0.1)
+
+        estimated_tau = process.find_timeshift(self.base_signal,
+                                               self.shifted_signal,
+                                               self.sample_rate,
+                                               method='pyramid',
+                                               plot=False)
+        testing.assert_allclose(estimated_tau, self.tau, atol=0.1)
+
+    def test_pyramid_timeshift(self):
+
+        estimated_tau, bound = process.pyramid_timeshift(
+            self.base_signal, self.shifted_signal, self.sample_rate,
+            min_samples=256)
+        assert 0.0 < bound <= 1.5 / self.sample_rate
+        testing.assert_allclose(estimated_tau, self.tau, atol=0.1)
+
     def test_truncate_data(self):
 
         truncated_signal1, truncated_signal2 = \
@@ -260,6 +961,256 @@ class TestTimeShiftRealData():
             len(self.truncated_time)
 
 
+def test_find_timewarp():
+
+    sample_rate = 100.0
+    time = process.time_vector(20000, sample_rate)
+    tau = -0.37
+    rate = 1.0004
+
+    np.random.seed(1)
+    noise = np.cumsum(np.random.randn(len(time) + 2000))
+    noise_time = process.time_vector(len(noise), sample_rate, -10.0)
+
+    base_signal = np.interp(time, noise_time, noise)
+    warped_signal = np.interp(rate * time + tau, noise_time, noise)
+
+    estimated_tau, estimated_rate = process.find_timewarp(
+        base_signal, warped_signal, sample_rate, min_samples=1024)
+    testing.assert_allclose(estimated_tau, tau, atol=0.01)
+    testing.assert_allclose(estimated_rate, rate, atol=1e-5)
+
+    estimated_tau, estimated_rate = process.find_timewarp(
+        base_signal, warped_signal, sample_rate, guess=(-0.3, 1.0))
+    testing.assert_allclose(estimated_tau, tau, atol=0.01)
+    testing.assert_allclose(estimated_rate, rate, atol=1e-5)
+
+    truncated1, truncated2 = process.truncate_warped_data(
+        estimated_tau, estimated_rate, base_signal, warped_signal,
+        sample_rate)
+    assert len(truncated1) == len(truncated2)
+    assert len(truncated2) > 0.99 * len(time)
+    testing.assert_allclose(truncated1, truncated2, atol=0.1)
+
+    error = process.warp_error(tau, rate, base_signal, warped_signal, time)
+    testing.assert_allclose(error, 0.0, atol=1e-8)
+    assert process.warp_error(tau, 1.0, base_signal, warped_signal,
+                              time) > 1.0
+
+
+def test_drift_tracker():
+
+    sample_rate = 100.0
+    time = process.time_vector(6000, sample_rate)
+    # the clock of the second signal runs slow, so the shift grows linearly
+    drift = 0.002
+    tau = -0.2 - drift * time
+
+    np.random.seed(0)
+    noise = np.cumsum(np.random.randn(len(time) + 2000))
+    noise_time = process.time_vector(len(noise), sample_rate, -10.0)
+
+    base_signal = np.interp(time, noise_time, noise)
+    shifted_signal = np.interp(time + tau, noise_time, noise)
+
+    tracker = process.DriftTracker(sample_rate, 10.0, step=5.0)
+
+    # feed the signals in chunks of different lengths
+    rows = []
+    for i in range(12):
+        rows.append(tracker.update(base_signal[700 * i:700 * (i + 1)],
+                                   shifted_signal[550 * i:550 * (i + 1)]))
+    rows = np.hstack(rows)
+
+    shifts = tracker.shifts()
+    testing.assert_equal(rows, shifts)
+
+    # windows start every 5 seconds and are 10 seconds long
+    assert len(shifts) == 11
+    testing.assert_allclose(shifts['time'], 4.995 + 5.0 * np.arange(11))
+    testing.assert_allclose(shifts['tau'],
+                            -0.2 - drift * shifts['time'], atol=0.02)
+    assert shifts['converged'].all()
+
+    # the buffers only hold samples that later windows need
+    assert len(tracker._buffer1) < tracker.window_length
+
+
+def test_subtract_mean_and_normalize():
+
+    sig = np.array([[1.0, 2.0, 3.0, 6.0],
+                    [2.0, np.nan, 4.0, 6.0]])
+
+    testing.assert_allclose(process.subtract_mean(sig[0]),
+                            [-2.0, -1.0, 0.0, 3.0])
+    testing.assert_allclose(process.subtract_mean(sig, axis=1),
+                            [[-2.0, -1.0, 0.0, 3.0],
+                             [-2.0, np.nan, 0.0, 2.0]])
+    testing.assert_allclose(process.subtract_mean(sig),
+                            sig - np.nanmean(sig))
+
+    testing.assert_allclose(process.normalize(sig, axis=-1),
+                            [[1.0 / 6.0, 2.0 / 6.0, 0.5, 1.0],
+                             [2.0 / 6.0, np.nan, 4.0 / 6.0, 1.0]])
+    testing.assert_allclose(process.normalize(sig[:, 1], hasNans=True),
+                            [1.0, np.nan])
+
+    # the dtype is kept and the result can be computed in place
+    single = sig.astype(np.float32)
+    result = process.subtract_mean(single, axis=0, out=single)
+    assert result is single
+    assert single.dtype == np.float32
+    testing.assert_allclose(single[:, 0], [-0.5, 0.5])
+
+    assert process.normalize(np.arange(4)).dtype == np.float64
+
+
+def test_derivative():
+
+    x = np.linspace(0.0, 2.0, 2001)
+    y = np.sin(3.0 * x)
+    dydx = 3.0 * np.cos(3.0 * x)
+    d2ydx2 = -9.0 * np.sin(3.0 * x)
+
+    testing.assert_allclose(process.derivative(x, y),
+                            np.diff(y) / np.diff(x), atol=1e-10)
+    testing.assert_allclose(process.derivative(x, y, method='backward'),
+                            np.diff(y) / np.diff(x), atol=1e-10)
+
+    combination = process.derivative(x, y, method='combination')
+    testing.assert_allclose(combination[0],
+                            (-3 * y[0] + 4 * y[1] - y[2]) / 2 / (x[1] - x[0]))
+    testing.assert_allclose(combination[1:-1], (y[2:] - y[:-2]) / 2 /
+                            (x[1] - x[0]))
+    testing.assert_allclose(combination, dydx, atol=1e-4)
+
+    testing.assert_allclose(process.derivative(x, y, method='central'),
+                            dydx[1:-1], atol=1e-5)
+    testing.assert_allclose(process.derivative(x, y, method='central',
+                                               accuracy=4),
+                            dydx[2:-2], atol=1e-10)
+    testing.assert_allclose(process.derivative(x, y, method='combination',
+                                               n=2, accuracy=4),
+                            d2ydx2, atol=1e-6)
+
+    # unevenly spaced samples
+    np.random.seed(0)
+    x = np.sort(np.random.uniform(0.0, 2.0, 3000))
+    y = np.sin(3.0 * x)
+    testing.assert_allclose(process.derivative(x, y, method='combination'),
+                            3.0 * np.cos(3.0 * x), atol=1e-3)
+    testing.assert_allclose(process.derivative(x, y, method='forward',
+                                               accuracy=3),
+                            3.0 * np.cos(3.0 * x[:-3]), atol=1e-5)
+
+    # along an axis of a 2D array
+    y = np.vstack((np.sin(3.0 * x), np.cos(3.0 * x))).T
+    expected = np.vstack((3.0 * np.cos(3.0 * x), -3.0 * np.sin(3.0 * x))).T
+    testing.assert_allclose(process.derivative(x, y, method='combination',
+                                               axis=0), expected, atol=1e-3)
+
+    testing.assert_raises(ValueError, process.derivative, x, y[:, 0],
+                          method='central', accuracy=3)
+    testing.assert_raises(ValueError, process.derivative, x, y[:, 0],
+                          method='spline')
+
+
+def test_smooth_derivatives():
+
+    sample_rate = 100.0
+    time = process.time_vector(1000, sample_rate)
+
+    # the filter is exact for polynomials up to its order
+    y = 2.0 - time + 0.5 * time ** 2 - 0.1 * time ** 3
+    smoothed, first, second = process.smooth_derivatives(y, sample_rate, 31,
+                                                         polyorder=3)
+    testing.assert_allclose(smoothed, y, atol=1e-8)
+    testing.assert_allclose(first, -1.0 + time - 0.3 * time ** 2, atol=1e-8)
+    testing.assert_allclose(second, 1.0 - 0.6 * time, atol=1e-8)
+
+    np.random.seed(0)
+    noisy = np.sin(2.0 * time) + 0.01 * np.random.randn(len(time))
+    smoothed, first, second = process.smooth_derivatives(noisy, sample_rate,
+                                                         51)
+    testing.assert_allclose(first[25:-25], 2.0 * np.cos(2.0 * time[25:-25]),
+                            atol=0.1)
+
+    # chunk by chunk gives the same result
+    smoother = process.SmoothDerivatives(sample_rate, 51)
+    chunks = [smoother.update(noisy[i:i + 7]) for i in range(0, 1000, 7)]
+    chunks.append(smoother.finish())
+    for i, expected in enumerate([smoothed, first, second]):
+        testing.assert_allclose(np.hstack([c[i] for c in chunks]), expected)
+
+    # along the first axis
+    data = np.vstack((noisy, y)).T
+    smoothed, first, second = process.smooth_derivatives(data, sample_rate,
+                                                         51, axis=0)
+    testing.assert_allclose(second[:, 1], 1.0 - 0.6 * time, atol=1e-8)
+
+    testing.assert_raises(ValueError, process.SmoothDerivatives, sample_rate,
+                          30)
+
+
+def test_load_csv():
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'grf.csv')
+        with open(path, 'w') as f:
+            f.write('time,force\n')
+        with open(path, 'a') as f, open(os.path.join(
+                os.path.dirname(__file__),
+                'data/example_vertical_grf.csv')) as example:
+            f.write(example.read())
+        expected = np.loadtxt(path, delimiter=',', skiprows=1)
+
+        data, metadata = process.load_csv(path, header=True,
+                                          time_column='time', chunk_size=1000)
+        assert isinstance(data, np.memmap)
+        testing.assert_allclose(data, expected)
+        assert metadata['columns'] == ['time', 'force']
+        testing.assert_allclose(metadata['start_time'], expected[0, 0])
+        testing.assert_allclose(metadata['sample_rate'],
+                                1.0 / np.mean(np.diff(expected[:, 0])))
+        time = process.TimeBase(metadata['start_time'],
+                                metadata['sample_rate'], len(data))
+        # the example's sample times jitter, but within half a sample
+        testing.assert_allclose(time.values(), expected[:, 0],
+                                atol=0.5 / metadata['sample_rate'])
+
+        # the cache is reused
+        cache_time = os.stat(path + '.npy').st_mtime
+        data, cached_metadata = process.load_csv(path, header=True,
+                                                 time_column='time')
+        assert cached_metadata == metadata
+        assert os.stat(path + '.npy').st_mtime == cache_time
+        testing.assert_allclose(data, expected)
+        del data
+
+        # and rebuilt when the source changes
+        with open(path, 'a') as f:
+            f.write('600.0,1.0\n')
+        data, metadata = process.load_csv(path, header=True,
+                                          time_column='time')
+        assert len(data) == len(expected) + 1
+        testing.assert_allclose(data[-1], [600.0, 1.0])
+        assert metadata['evenly_sampled'] is False
+
+        # or when it's parsed differently
+        cache_dir = os.path.join(directory, 'cache')
+        os.mkdir(cache_dir)
+        data, metadata = process.load_csv(path, skiprows=1, sample_rate=100.0,
+                                          cache_dir=cache_dir)
+        assert os.path.exists(os.path.join(cache_dir, 'grf.csv.npy'))
+        assert metadata['columns'] == ['0', '1']
+        assert metadata['sample_rate'] == 100.0
+        assert metadata['start_time'] is None
+        del data
+    finally:
+        shutil.rmtree(directory)
+
+
 def test_time_vector():
 
     expected_time = [0.0, 1.0, 2.0, 3.0, 4.0]
@@ -267,3 +1218,56 @@ def test_time_vector():
 
     expected_time = [1.0, 2.0, 3.0, 4.0, 5.0]
     testing.assert_allclose(process.time_vector(5, 1.00, 1.0), expected_time)
+
+    time = process.time_vector(5, 1.0, 1.0, lazy=True)
+    assert isinstance(time, process.TimeBase)
+    testing.assert_allclose(np.asarray(time), expected_time)
+
+
+def test_time_base():
+
+    time = process.TimeBase(-1.0, 100.0, 1001)
+    expected = process.time_vector(1001, 100.0, -1.0)
+
+    assert len(time) == 1001
+    testing.assert_allclose(time.values(), expected)
+    testing.assert_allclose(time[10], expected[10])
+    testing.assert_allclose(time[-1], expected[-1])
+    testing.assert_allclose(time.stop, expected[-1])
+    testing.assert_allclose(time[[3, 7]], expected[[3, 7]])
+    testing.assert_raises(IndexError, time.__getitem__, 1001)
+
+    sliced = time[10:500:3]
+    assert isinstance(sliced, process.TimeBase)
+    testing.assert_allclose(sliced.values(), expected[10:500:3], atol=1e-12)
+    assert len(time[2000:]) == 0
+
+    testing.assert_allclose(time.index(expected[[0, 15]]), [0.0, 15.0])
+
+    # arithmetic with scalars doesn't compute the values
+    for shifted in [time + 0.5, 0.5 + time, time - (-0.5),
+                    time + np.array([0.5])]:
+        assert isinstance(shifted, process.TimeBase)
+        testing.assert_allclose(shifted.values(), expected + 0.5)
+    for scaled in [time * 2.0, np.float64(2.0) * time]:
+        assert isinstance(scaled, process.TimeBase)
+        testing.assert_allclose(scaled.values(), 2.0 * expected)
+    testing.assert_allclose(time + expected, 2.0 * expected)
+    testing.assert_allclose(1.0 - time, 1.0 - expected)
+
+    for value in [-2.0, -1.0, 0.004, 0.01, 3.555, 9.0, 12.0]:
+        for side in ['left', 'right']:
+            assert (time.searchsorted(value, side=side) ==
+                    np.searchsorted(expected, value, side=side))
+
+    values = np.sin(expected)
+    points = np.linspace(-2.0, 10.0, 777)
+    testing.assert_allclose(time.interp(points, values),
+                            np.interp(points, expected, values))
+
+    # shifted time bases, including past the ends and by whole samples
+    for shift in [-20.003, -0.5, -0.01, 0.0, 0.0237, 0.03, 3.3, 20.0]:
+        for shifted in [time + shift, time[100:300] + shift]:
+            testing.assert_allclose(time.interp(shifted, values),
+                                    np.interp(shifted.values(), expected,
+                                              values), atol=1e-12)